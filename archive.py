@@ -0,0 +1,190 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from constants import *
+
+
+class WorkbookArchive:
+    """Every workbook we've downloaded, indexed by report date and URL, with the ETag
+    and Last-Modified it came with so it can be revalidated before reuse. Each distinct
+    file is stored once, gzipped, under the SHA-256 of its contents, and checked against
+    it when it's read back; a copy that doesn't match is dropped. Files that haven't
+    been used in max_age seconds are evicted, and then the least recently used ones
+    until the archive fits in max_bytes."""
+
+    def __init__(
+        self,
+        directory=ARCHIVE_DIR,
+        max_bytes=ARCHIVE_MAX_BYTES,
+        max_age=ARCHIVE_MAX_AGE,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        # The archive can be shared between threads, so the connection is locked
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(directory, ARCHIVE_INDEX_FILE), check_same_thread=False
+        )
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, "
+                "size INTEGER, stored_size INTEGER, last_used REAL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (report_date TEXT, url TEXT, "
+                "digest TEXT, etag TEXT, last_modified TEXT, "
+                "PRIMARY KEY (report_date, url))"
+            )
+            # Indexes from before the validators were kept don't have them
+            columns = [c[1] for c in self._db.execute("PRAGMA table_info(entries)")]
+            for column in ["etag", "last_modified"]:
+                if column not in columns:
+                    self._db.execute(
+                        "ALTER TABLE entries ADD COLUMN {} TEXT".format(column)
+                    )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, "objects", digest + ".gz")
+
+    def get(self, report_date, url):
+        """Gets the contents of the workbook for a report date and URL, or None if we
+        don't have it."""
+        with self._lock:
+            found = self._db.execute(
+                "SELECT digest FROM entries WHERE report_date = ? AND url = ?",
+                (report_date.isoformat(), url),
+            ).fetchone()
+        if found is None:
+            return None
+
+        digest = found[0]
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = gzip.decompress(f.read())
+        except (OSError, EOFError, zlib.error):
+            data = None
+        with self._lock, self._db:
+            if data is None or hashlib.sha256(data).hexdigest() != digest:
+                self._forget(digest)
+                return None
+            self._db.execute(
+                "UPDATE objects SET last_used = ? WHERE digest = ?",
+                (time.time(), digest),
+            )
+        return data
+
+    def validators(self, report_date, url):
+        """Gets the ETag and Last-Modified the server sent with the workbook for a
+        report date and URL, as the meta that download_to_buffer takes, or None if we
+        don't have it."""
+        with self._lock:
+            found = self._db.execute(
+                "SELECT etag, last_modified FROM entries "
+                "WHERE report_date = ? AND url = ?",
+                (report_date.isoformat(), url),
+            ).fetchone()
+        if found is None:
+            return None
+        return {"etag": found[0], "last_modified": found[1]}
+
+    def put(self, report_date, url, data, validators=None):
+        """Adds the contents of the workbook for a report date and URL (anything that
+        supports the buffer protocol), along with the validators the server sent with
+        it, and returns its digest. A file we already have isn't stored again."""
+        validators = validators or {}
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        with self._lock, self._db:
+            found = self._db.execute(
+                "SELECT 1 FROM objects WHERE digest = ?", (digest,)
+            ).fetchone()
+            if found is None or not os.path.exists(path):
+                compressed = gzip.compress(data)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(compressed)
+                os.replace(path + ".tmp", path)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                    (digest, len(data), len(compressed), time.time()),
+                )
+            else:
+                self._db.execute(
+                    "UPDATE objects SET last_used = ? WHERE digest = ?",
+                    (time.time(), digest),
+                )
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (
+                    report_date.isoformat(),
+                    url,
+                    digest,
+                    validators.get("etag"),
+                    validators.get("last_modified"),
+                ),
+            )
+            self._evict()
+        return digest
+
+    def discard(self, report_date, url):
+        """Drops the workbook for a report date and URL, like one that turned out not to
+        be readable. The file itself is left to be evicted, in case another entry uses
+        it."""
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM entries WHERE report_date = ? AND url = ?",
+                (report_date.isoformat(), url),
+            )
+
+    def _forget(self, digest):
+        self._db.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+        self._db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        cutoff = time.time() - self.max_age
+        total = 0
+        objects = self._db.execute(
+            "SELECT digest, stored_size, last_used FROM objects ORDER BY last_used DESC"
+        ).fetchall()
+        for digest, stored_size, last_used in objects:
+            if last_used < cutoff:
+                self._forget(digest)
+                continue
+            total += stored_size
+            if total > self.max_bytes:
+                self._forget(digest)
@@ -0,0 +1,69 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Times create_bar_chart over the whole history, back to February 26, 2020, with no
+data on weekends like the real report-date sheets. Run from the repository root:
+
+    python -m benchmarks.bar_chart
+"""
+
+import timeit
+from datetime import date, timedelta
+
+from infobox_and_barchart import create_bar_chart
+from series import DailyFrame
+
+START = date(2020, 2, 26)
+END = date(2021, 9, 10)
+
+
+def make_data(start, end):
+    dates = [start - timedelta(days=1)]
+    while dates[-1] != end:
+        dates.append(dates[-1] + timedelta(days=1))
+    data = DailyFrame.over(dates)
+    for column in ["confirmed_cases", "probable_cases", "total_cases", "deaths"]:
+        data.add(column)
+    total = 1000
+    for d in dates:
+        if d.weekday() <= 4:
+            total += 500
+            data["confirmed_cases"][d] = total - 100
+            data["probable_cases"][d] = 100
+            data["total_cases"][d] = total
+            data["deaths"][d] = total // 50
+    return data
+
+
+def main():
+    date_range = [START + timedelta(days=i) for i in range((END - START).days + 1)]
+    data = make_data(START, END)
+    runs = 20
+    elapsed = timeit.timeit(lambda: create_bar_chart(data, date_range), number=runs)
+    print(
+        "create_bar_chart: {} days, {:.2f} ms per chart".format(
+            len(date_range), elapsed / runs * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
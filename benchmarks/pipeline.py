@@ -0,0 +1,168 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Times each stage of the pipeline against a synthetic workbook (see
+benchmarks.workbook), reporting the best wall time over a number of runs and the peak
+memory allocated during a separate run under tracemalloc. Nothing is downloaded, and
+the workbook and outputs are written to a temporary directory. Run from the repository
+root:
+
+    python -m benchmarks.pipeline --years 2 --runs 5
+
+By default every run of a stage starts from a freshly opened workbook, so stages are
+timed along with the parsing they set off, as they would be in a real run. With --warm
+the sheets are parsed before each run, and only the stage itself is timed.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+from benchmarks.workbook import make_workbook
+from constants import *
+from excel import WorkbookSession, get_excel_data_for_date_range
+import cases_by_county_daily_table
+import infobox_and_barchart
+import statistics
+
+
+def get_stages(today, fromdate):
+    """Returns (name, function of workbook) for each stage. Stages that need the output
+    of an earlier one compute it before they're timed, as their setup."""
+    date_range = [
+        fromdate + timedelta(days=i) for i in range((today - fromdate).days + 1)
+    ]
+    return [
+        (
+            "get_excel_data_for_date_range",
+            None,
+            lambda wb, _: get_excel_data_for_date_range(
+                wb, date_range, "Cases (Report Date)"
+            ),
+        ),
+        (
+            "infobox_and_barchart.get_data",
+            None,
+            lambda wb, _: infobox_and_barchart.get_data(wb, date_range, today),
+        ),
+        (
+            "cases_by_county_daily_table.get_data",
+            None,
+            lambda wb, _: cases_by_county_daily_table.get_data(wb, today),
+        ),
+        (
+            "create_bar_chart",
+            lambda wb: infobox_and_barchart.get_data(wb, date_range, today),
+            lambda wb, data: infobox_and_barchart.create_bar_chart(data, date_range),
+        ),
+        (
+            "create_statistics_graphs",
+            None,
+            lambda wb, _: statistics.create_statistics_graphs(wb, today),
+        ),
+        (
+            "create_daily_county_table",
+            None,
+            lambda wb, _: cases_by_county_daily_table.create_daily_county_table(
+                wb, today
+            ),
+        ),
+    ]
+
+
+def run_stage(path, setup, stage, warm, traced):
+    """Runs a stage once against a freshly opened workbook, returning the wall time and,
+    if traced, the peak memory allocated while it ran."""
+    with WorkbookSession(path) as workbook:
+        if warm:
+            for sheetname in RAW_DATA_SHEETS:
+                workbook.get_sheet(sheetname).read_through()
+        data = setup(workbook) if setup else None
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        stage(workbook, data)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the pipeline against a synthetic workbook."
+    )
+    parser.add_argument(
+        "--years", type=float, default=1.5, help="years of history to generate"
+    )
+    parser.add_argument(
+        "--padding",
+        type=int,
+        default=0,
+        help="extra columns to add to each row of the dated sheets",
+    )
+    parser.add_argument(
+        "--days", type=int, default=30, help="days of the bar chart's date range"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="timed runs per stage")
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="parse the sheets before each run, so only the stage itself is timed",
+    )
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "workbook.xlsx")
+        start = time.perf_counter()
+        today = make_workbook(path, args.years, args.padding)
+        print(
+            "Generated {:,} byte workbook through {} in {:.2f} s".format(
+                os.path.getsize(path), today, time.perf_counter() - start
+            )
+        )
+        os.chdir(tmp)
+        os.mkdir(OUT_DIR)
+        try:
+            print("{:<40} {:>12} {:>12}".format("stage", "best (ms)", "peak (KiB)"))
+            for name, setup, stage in get_stages(
+                today, today - timedelta(days=args.days - 1)
+            ):
+                best = min(
+                    run_stage(path, setup, stage, args.warm, False)[0]
+                    for _ in range(args.runs)
+                )
+                _, peak = run_stage(path, setup, stage, args.warm, True)
+                print(
+                    "{:<40} {:>12.2f} {:>12,.0f}".format(name, best * 1000, peak / 1024)
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Writes synthetic raw-data workbooks with the sheet names and headings of the real
+MDPH workbook, so that the pipeline can be benchmarked offline. The numbers are made
+up but deterministic, so the same arguments always give the same workbook. Run from
+the repository root:
+
+    python -m benchmarks.workbook out.xlsx --years 2
+"""
+
+import argparse
+import os
+from datetime import date, datetime, timedelta
+
+from openpyxl import Workbook
+
+from constants import *
+from town_rollup import load_town_counties
+
+START = date(2020, 2, 26)
+
+COUNTY_DAILY_COUNTIES = [
+    "Barnstable",
+    "Berkshire",
+    "Bristol",
+    "Dukes",
+    "Essex",
+    "Franklin",
+    "Hampden",
+    "Hampshire",
+    "Middlesex",
+    "Nantucket",
+    "Norfolk",
+    "Plymouth",
+    "Suffolk",
+    "Worcester",
+    "Unknown",
+]
+
+
+def report_sheet(headings, values, weekdays_only=False):
+    """A sheet with one row per day, made from a function of the day's position in the
+    history. Report-date sheets have no rows on weekends."""
+
+    def rows(days, padding):
+        yield headings + ["Extra {}".format(i + 1) for i in range(padding)]
+        for i, d in enumerate(days):
+            if weekdays_only and d.weekday() > 4:
+                continue
+            yield [datetime(d.year, d.month, d.day)] + values(i) + [i] * padding
+
+    return rows
+
+
+def county_daily_rows(days, padding):
+    yield [
+        "Date",
+        "County",
+        "Total Confirmed Cases",
+        "Total Probable and Confirmed Cases",
+        "Total Confirmed Deaths",
+        "Total Probable and Confirmed Deaths",
+    ] + ["Extra {}".format(i + 1) for i in range(padding)]
+    for i, d in enumerate(days):
+        for k, county in enumerate(COUNTY_DAILY_COUNTIES):
+            cases = (k + 1) * (100 + i * 20)
+            deaths = (k + 1) * (1 + i // 5)
+            yield [
+                datetime(d.year, d.month, d.day),
+                county,
+                cases - cases // 10,
+                cases,
+                deaths - deaths // 10,
+                deaths,
+            ] + [i] * padding
+
+
+def city_town_rows(end):
+    counties, codes = load_town_counties()
+    start = end - timedelta(days=13)
+    yield [
+        "City/Town",
+        "County",
+        "Start_Date",
+        "End_Date",
+        TOWN_VALUE_HEADINGS[0],
+        TOWN_VALUE_HEADINGS[1],
+    ]
+    for k, (town, code) in enumerate(sorted(codes.items())):
+        yield [town, counties[code], start, end, 100 + k * 7, k % 40]
+    yield ["Unknown town", None, start, end, 12, 1]
+    yield ["State", None, start, end, 999999, 9999]
+
+
+SHEETS = {
+    "Cases (Report Date)": report_sheet(
+        ["Date", "Positive Total", "Positive New", "Probable Total", "Probable New"],
+        lambda i: [1000 + i * 500, 500, 100 + i * 50, 50],
+        weekdays_only=True,
+    ),
+    "DeathsReported (Report Date)": report_sheet(
+        [
+            "Date",
+            "DeathsConfTotal",
+            "DeathsConfNew",
+            "DeathsProbTotal",
+            "DeathsProbNew",
+        ],
+        lambda i: [10 + i * 10, 10, 2 + i, 1],
+        weekdays_only=True,
+    ),
+    "Testing2 (Report Date)": report_sheet(
+        [
+            "Date",
+            "Molecular All Tests Total",
+            "Molecular Total",
+            "Antigen Total",
+        ],
+        lambda i: [100000 + i * 9000, 50000 + i * 4000, 2000 + i * 30],
+    ),
+    "CasesByDate (Test Date)": report_sheet(
+        [
+            "Date",
+            "Positive Total",
+            "Positive New",
+            "7-day confirmed case average",
+        ],
+        lambda i: [900 + i * 490, 490, 486.3 + (i % 7) * 3.7],
+    ),
+    "DateofDeath": report_sheet(
+        [
+            "Date of Death",
+            "Confirmed Deaths",
+            "Confirmed Total",
+            "7-day confirmed death average",
+        ],
+        lambda i: [10, 5 + i * 10, 9.43 + (i % 5) * 0.21],
+    ),
+    "Hospitalization from Hospitals": report_sheet(
+        [
+            "Date",
+            "Total number of COVID patients in hospital today",
+            "ICU",
+            "Intubated",
+        ],
+        lambda i: [300 + i % 400, 80 + i % 90, 40 + i % 70],
+    ),
+}
+
+
+def end_date(years):
+    """The last day of a history of the given number of years, starting from the first
+    day the real charts start on. The last day is a weekday, as report dates are."""
+    end = START + timedelta(days=round(years * 365))
+    while end.weekday() > 4:
+        end = end + timedelta(days=1)
+    return end
+
+
+def make_workbook(path, years=1.5, padding=0):
+    """Writes a synthetic workbook covering years of history. Each dated sheet gets
+    padding extra numeric columns, to scale up the size of each row. Returns the last
+    date in the workbook."""
+    end = end_date(years)
+    days = [START + timedelta(days=i) for i in range((end - START).days + 1)]
+    wb = Workbook(write_only=True)
+    for sheetname, rows in SHEETS.items():
+        ws = wb.create_sheet(sheetname)
+        for row in rows(days, padding):
+            ws.append(row)
+    ws = wb.create_sheet("County_Daily")
+    for row in county_daily_rows(days, padding):
+        ws.append(row)
+    ws = wb.create_sheet(TOWN_SHEET)
+    for row in city_town_rows(end):
+        ws.append(row)
+    wb.save(path)
+    return end
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic raw-data workbook for benchmarking."
+    )
+    parser.add_argument("path", help="where to write the workbook")
+    parser.add_argument(
+        "--years", type=float, default=1.5, help="years of history to generate"
+    )
+    parser.add_argument(
+        "--padding",
+        type=int,
+        default=0,
+        help="extra columns to add to each row of the dated sheets",
+    )
+    args = parser.parse_args()
+    end = make_workbook(args.path, args.years, args.padding)
+    print(
+        "Wrote {} ({:,} bytes) with data through {}".format(
+            args.path, os.path.getsize(args.path), end
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -18,9 +18,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os
 from constants import *
-from openpyxl import load_workbook
+from profiling import profiler
+from render import name_fields, open_output
+from series import DailyFrame
 from utils import comma_separate
 
 TOTAL_POPULATION = 6892503
@@ -38,6 +39,72 @@ HEADER_STYLE = (
     '! style="text-align:right; padding-right:17px; padding-left:3px;" scope="row" '
 )
 ROW_STYLE = 'style="padding:0px 2px;" '
+# Row templates, put together once from the pieces above so that each row is rendered
+# with a single format call
+HEADER_ROW = (
+    "|-\n"
+    + HEADER_STYLE
+    + "| '''14 / 14'''\n"
+    + HEADER_STYLE
+    + "| '''{cases:,}'''\n"
+    + HEADER_STYLE
+    + "| '''{deaths:,}'''\n"
+    + HEADER_STYLE
+    + "| '''{population:,}'''\n"
+    + HEADER_STYLE
+    + "| '''"
+    + name_fields(CASES_PER_POP_FORMULA, "cases", "divided_pop")
+    + "'''\n"
+    + HEADER_STYLE
+    + "| '''"
+    + name_fields(DEATHS_PER_POP_FORMULA, "deaths", "divided_pop")
+    + "'''\n"
+    + HEADER_STYLE
+    + "| '''"
+    + name_fields(DEATHS_CASES_FORMULA, "deaths", "divided_cases")
+    + "'''\n"
+)
+COUNTY_ROW_START = (
+    "|-\n! "
+    + ROW_STYLE
+    + "|{wikilink}\n| "
+    + ROW_STYLE
+    + "|{cases:,}\n| "
+    + ROW_STYLE
+    + "|{deaths:,}\n"
+)
+COUNTY_ROW_END = (
+    "| " + name_fields(DEATHS_CASES_FORMULA, "deaths", "divided_cases") + "\n"
+)
+COUNTY_ROW = (
+    COUNTY_ROW_START
+    + "| "
+    + ROW_STYLE
+    + "|{population:,}\n| "
+    + name_fields(CASES_PER_POP_FORMULA, "cases", "divided_pop")
+    + "\n| "
+    + name_fields(DEATHS_PER_POP_FORMULA, "deaths", "divided_pop")
+    + "\n"
+    + COUNTY_ROW_END
+)
+NO_POPULATION_COUNTY_ROW = (
+    COUNTY_ROW_START + ("| " + ROW_STYLE + "| n/a\n") * 3 + COUNTY_ROW_END
+)
+FOOTER = (
+    '|- style="text-align:center;" class="sortbottom"\n'
+    '| colspan="7" | {{{{resize|Updated {today}}}}}<br/>'
+    "{{{{resize|Data is publicly reported by Massachusetts Department of Public "
+    "Health}}}}<ref>{{{{cite web |title=COVID-19 Updates and Information |"
+    "url=https://www.mass.gov/info-details/covid-19-updates-and-information "
+    "|website=Massachusetts Department of Public Health "
+    "|accessdate={today}}}}}</ref>"
+    "<ref>{{{{cite web |title=COVID-19 Response Reporting |"
+    "url=https://www.mass.gov/info-details/covid-19-response-reporting "
+    "|website=Massachusetts Department of Public Health "
+    "|accessdate={today}}}}}</ref>\n"
+)
+# Dukes and Nantucket are reported together
+COUNTY_ALIASES = {"Dukes": "Dukes and Nantucket", "Nantucket": "Dukes and Nantucket"}
 COUNTIES = [
     {
         "county": "Barnstable",
@@ -109,97 +176,87 @@ COUNTIES = [
 ]
 
 
-def get_data(xlsx_path, today):
-    data = {
-        c["county"]: {"population": c["population"], "cases": 0, "deaths": 0}
-        for c in COUNTIES
-    }
-
-    wb = load_workbook(filename=xlsx_path, data_only=True)
-    sheet = wb["County_Daily"]
-    for ind, row in enumerate(sheet.rows):
-        if ind == 0:
-            continue
-        dt = row[0].value
-        if dt and dt.date() == today:
-            county = row[1].value
-            if county in ["Dukes", "Nantucket", "Dukes and Nantucket"]:
-                county = "Dukes and Nantucket"
-            if row[3].value:
-                data[county]["cases"] += int(row[3].value)
-            if row[5].value:
-                data[county]["deaths"] += int(row[5].value)
+def get_county_matrix(workbook, start, end):
+    """Gets every county's cases and deaths for each day from start to end (inclusive)
+    as ("cases", county) and ("deaths", county) columns, in a single pass over the
+    sheet's rows for those days. Counties that aren't in COUNTIES get columns too."""
+    data = DailyFrame(start, (end - start).days + 1)
+    columns = {}
+    for c in COUNTIES:
+        columns[c["county"]] = (
+            data.add(("cases", c["county"]), 0).values,
+            data.add(("deaths", c["county"]), 0).values,
+        )
+
+    first = start.toordinal()
+    for row in workbook.get_sheet("County_Daily").rows_between(start, end):
+        county = COUNTY_ALIASES.get(row[1], row[1])
+        if county not in columns:
+            columns[county] = (
+                data.add(("cases", county), 0).values,
+                data.add(("deaths", county), 0).values,
+            )
+        cases, deaths = columns[county]
+        ind = row[0].toordinal() - first
+        if row[3]:
+            cases[ind] += int(row[3])
+        if row[5]:
+            deaths[ind] += int(row[5])
     return data
 
 
-def create_header_row(data):
+def get_data(workbook, today):
+    """Gets each county's cases and deaths for today."""
+    return get_county_matrix(workbook, today, today)
+
+
+def create_header_row(data, today):
     total_cases = 0
     total_deaths = 0
     for c in COUNTIES:
-        total_cases += data[c["county"]]["cases"]
-        total_deaths += data[c["county"]]["deaths"]
-    divided_pop = TOTAL_POPULATION / 100000
-
-    row = "|-\n"
-    row += HEADER_STYLE + "| '''14 / 14'''\n"
-    row += HEADER_STYLE + "| '''{:,}'''\n".format(total_cases)
-    row += HEADER_STYLE + "| '''{:,}'''\n".format(total_deaths)
-    row += HEADER_STYLE + "| '''{:,}'''\n".format(TOTAL_POPULATION)
-    row += HEADER_STYLE + "| '''{}'''\n".format(
-        CASES_PER_POP_FORMULA.format(total_cases, divided_pop)
-    )
-    row += HEADER_STYLE + "| '''{}'''\n".format(
-        DEATHS_PER_POP_FORMULA.format(total_deaths, divided_pop)
+        total_cases += data[("cases", c["county"])][today]
+        total_deaths += data[("deaths", c["county"])][today]
+    return HEADER_ROW.format(
+        cases=total_cases,
+        deaths=total_deaths,
+        population=TOTAL_POPULATION,
+        divided_pop=TOTAL_POPULATION / 100000,
+        divided_cases=total_cases / 100,
     )
-    row += HEADER_STYLE + "| '''{}'''\n".format(
-        DEATHS_CASES_FORMULA.format(total_deaths, total_cases / 100)
+
+
+def create_county_row(county, cases, deaths):
+    template = COUNTY_ROW if county["population"] else NO_POPULATION_COUNTY_ROW
+    return template.format(
+        wikilink=county["wikilink"],
+        cases=cases,
+        deaths=deaths,
+        population=county["population"],
+        divided_pop=county["population"] / 100000 if county["population"] else None,
+        divided_cases=cases / 100,
     )
-    return row
-
-
-def create_county_row(county, data):
-    divided_pop = county["population"] / 100000 if county["population"] else None
-    row = "|-\n"
-    row += "! " + ROW_STYLE + "|{}\n".format(county["wikilink"])
-    row += "| " + ROW_STYLE + "|{:,}\n".format(data["cases"])
-    row += "| " + ROW_STYLE + "|{:,}\n".format(data["deaths"])
-    if county["population"]:
-        row += "| " + ROW_STYLE + "|{:,}\n".format(county["population"])
-        row += "| " + CASES_PER_POP_FORMULA.format(data["cases"], divided_pop) + "\n"
-        row += "| " + DEATHS_PER_POP_FORMULA.format(data["deaths"], divided_pop) + "\n"
-    else:
-        for i in range(3):
-            row += "| " + ROW_STYLE + "| n/a\n"
-    row += "| " + DEATHS_CASES_FORMULA.format(data["deaths"], data["cases"] / 100)
-    row += "\n"
-    return row
 
 
 def create_footer(today):
-    pretty_today = today.strftime(CITATION_DATE_FORMAT)
-    row = '|- style="text-align:center;" class="sortbottom"\n'
-    row += '| colspan="7" | {{{{resize|Updated {}}}}}<br/>'.format(pretty_today)
-    row += "{{resize|Data is publicly reported by Massachusetts Department of Public "
-    row += "Health}}<ref>{{cite web |title=COVID-19 Updates and Information |"
-    row += "url=https://www.mass.gov/info-details/covid-19-updates-and-information "
-    row += "|website=Massachusetts Department of Public Health "
-    row += "|accessdate={}}}}}</ref>".format(pretty_today)
-    row += "<ref>{{cite web |title=COVID-19 Response Reporting |"
-    row += "url=https://www.mass.gov/info-details/covid-19-response-reporting "
-    row += "|website=Massachusetts Department of Public Health "
-    row += "|accessdate={}}}}}</ref>\n".format(pretty_today)
-    return row
+    return FOOTER.format(today=today.strftime(CITATION_DATE_FORMAT))
 
 
 def create_table(data, today):
-    rows = [create_header_row(data)]
-    for c in COUNTIES:
-        rows.append(create_county_row(c, data[c["county"]]))
-    rows.append(create_footer(today))
-    with open(os.path.join(OUT_DIR, "daily_county.txt"), "w+") as f:
-        f.write("".join(rows))
+    with open_output("daily_county.txt") as f:
+        f.write(create_header_row(data, today))
+        for c in COUNTIES:
+            f.write(
+                create_county_row(
+                    c,
+                    data[("cases", c["county"])][today],
+                    data[("deaths", c["county"])][today],
+                )
+            )
+        f.write(create_footer(today))
 
 
-def create_daily_county_table(xlsx_path, today):
-    data = get_data(xlsx_path, today)
-    create_table(data, today)
+def create_daily_county_table(workbook, today):
+    with profiler.stage("get_data"):
+        data = get_data(workbook, today)
+    with profiler.stage("write"):
+        create_table(data, today)
@@ -1,6 +1,82 @@
 TMP_DIR = "tmp"
 DATA_DIR = "data"
 OUT_DIR = "out"
+HISTORY_DIR = "history"
+BACKFILL_DIR = "backfill"
+ARCHIVE_DIR = "archive"
+
+# Sheets of the raw data workbook that the generators read
+RAW_DATA_SHEETS = [
+    "Cases (Report Date)",
+    "DeathsReported (Report Date)",
+    "Testing2 (Report Date)",
+    "CasesByDate (Test Date)",
+    "DateofDeath",
+    "Hospitalization from Hospitals",
+    "County_Daily",
+]
+
+# The stages that --only can select, and the sheets each of them reads
+STAGE_SHEETS = {
+    "infobox": [
+        "Cases (Report Date)",
+        "DeathsReported (Report Date)",
+        "Testing2 (Report Date)",
+        "CasesByDate (Test Date)",
+        "DateofDeath",
+        "Hospitalization from Hospitals",
+    ],
+    "county": ["County_Daily"],
+    "statistics": ["CasesByDate (Test Date)", "DateofDeath"],
+}
+
+# In watch mode, the day's URL is checked this often (in seconds) at first, backing
+# off to WATCH_MAX_INTERVAL while it's still not there. Once the day's output has been
+# generated, or on weekends, it checks for the next day every WATCH_IDLE_INTERVAL.
+WATCH_INTERVAL = 15
+WATCH_BACKOFF = 1.5
+WATCH_MAX_INTERVAL = 120
+WATCH_IDLE_INTERVAL = 600
+
+# With --serve, outputs are served on this port, and this many responses are cached
+SERVER_PORT = 8000
+SERVER_CACHE_SIZE = 64
+
+# Output files are written through a buffer of this many bytes
+OUTPUT_BUFFER_SIZE = 256 * 1024
+
+# The weekly sheet of cases by city or town, and the columns we roll up from it
+TOWN_SHEET = "City_town"
+TOWN_HEADING = "City/Town"
+TOWN_VALUE_HEADINGS = ["Total Case Counts", "Two Week Case Counts"]
+# Rows of the town sheet that aren't towns: the statewide totals and the cases whose
+# town isn't known. They aren't rolled up into any county.
+TOWN_SKIPPED_ROWS = ["State", "Unknown town"]
+TOWN_COUNTIES_FILE = "town_counties.tsv"
+
+# Downloaded workbooks are kept in ARCHIVE_DIR, gzipped, up to this many bytes. Ones
+# that haven't been used for ARCHIVE_MAX_AGE seconds are dropped.
+ARCHIVE_INDEX_FILE = "index.sqlite"
+ARCHIVE_MAX_BYTES = 1024 * 1024 * 1024
+ARCHIVE_MAX_AGE = 180 * 24 * 60 * 60
+
+# Parsed sheets are cached in TMP_DIR between runs, up to this many bytes
+SHEET_CACHE_FILE = "sheets.sqlite"
+SHEET_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# With --profile, the report (and the cProfile statistics of the slowest stage, if
+# asked for) are written to OUT_DIR
+PROFILE_REPORT_FILE = "profile.json"
+PROFILE_STATS_FILE = "profile_slowest.prof"
+
+# The vaccination data used on the last run is kept in TMP_DIR, to be reused when
+# there's nothing newer
+MANUAL_DATA_CACHE_FILE = "manual_data.json"
+# What's written in place of each vaccination figure when there isn't any to use
+MANUAL_DATA_PLACEHOLDER = "XXX"
+
+# In incremental mode, the rendered charts and their inputs are kept in TMP_DIR
+RENDER_STATE_FILE = "render.pickle"
 
 URL = "https://www.mass.gov/doc/covid-19-raw-data-{}/download"
 # EXCEL_URL = "https://www.mass.gov/doc/chapter-93-state-numbers-daily-report-{}/download"
@@ -18,6 +94,14 @@ AS_OF_ALT_FMT = "%B{{nbsp}}%-d"
 REQUEST_HEADER = {
     "user-agent": "COVID in Massachusetts data parser: https://github.com/molly/wikipedia-covid-ma"
 }
+# Connect and read timeouts, in seconds
+DOWNLOAD_TIMEOUT = (10, 60)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RETRIES = 4
+# Seconds to wait before the first retry; this doubles with each attempt
+DOWNLOAD_BACKOFF = 2
+# How many past days' workbooks to download at once when backfilling
+BACKFILL_CONCURRENCY = 4
 #
 # EMPTY_COUNTY_TABLE_ROW = (
 #     '|-\n| style="text-align:left;" | ⋮\n| style="border-left: 2px solid #888;" |\n|\n'
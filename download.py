@@ -0,0 +1,247 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from constants import *
+
+# Responses worth trying again, since they're usually the server having a bad moment
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class DownloadError(Exception):
+    def __init__(self, status_code, reason):
+        super().__init__(status_code, reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+class TransientDownloadError(DownloadError):
+    pass
+
+
+def make_session(pool_size=1):
+    """Makes an HTTP session whose connections are pooled and reused across requests.
+    The pool should be at least as big as the number of threads sharing the session."""
+    session = requests.Session()
+    session.headers.update(REQUEST_HEADER)
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def read_meta(path):
+    try:
+        with open(path + ".meta") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_meta(path, meta):
+    with open(path + ".meta", "w") as f:
+        json.dump(meta, f)
+
+
+def response_meta(response):
+    """The validators of a response, to send back when checking if it has changed."""
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def conditional_headers(meta):
+    """Headers that ask the server to only send a file if it has changed since the copy
+    with these validators."""
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def download(url, path, session=None):
+    """Downloads url to path, streaming it to disk, and returns the number of bytes that
+    were transferred.
+
+    If we've downloaded this file before, the server is asked to only send it again if
+    it has changed. A download that's interrupted is kept in a .part file and resumed
+    from where it stopped on the next attempt. Connection problems and server errors
+    are retried with exponential backoff."""
+    session = session or make_session()
+    return with_retries(download_once, url, path, session)
+
+
+def download_to_buffer(url, buffer, session=None, meta=None):
+    """Downloads url into a binary buffer (like a BytesIO), leaving it at the start, and
+    returns the number of bytes that were transferred. Failed attempts are retried as
+    in download, but start again from the beginning.
+
+    If meta holds the validators of a copy we already have, the server is asked to only
+    send the file if it has changed; if it hasn't, nothing is written and 0 is
+    returned. Otherwise meta is updated with the validators of the new download."""
+    session = session or make_session()
+    return with_retries(download_to_buffer_once, url, buffer, session, meta)
+
+
+def with_retries(fn, *args):
+    """Calls fn, retrying connection problems and server errors with exponential
+    backoff."""
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return fn(*args)
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            TransientDownloadError,
+        ):
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            time.sleep(DOWNLOAD_BACKOFF * 2**attempt)
+
+
+def is_published(url, session=None):
+    """Checks whether url is there yet, without downloading it. If the server doesn't
+    answer HEAD requests, it's sent a GET whose body is never read."""
+    session = session or make_session()
+    r = session.head(url, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True)
+    if r.status_code in (405, 501):
+        with session.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as r:
+            pass
+    if r.status_code == 404:
+        return False
+    if r.status_code != 200:
+        raise DownloadError(r.status_code, r.reason)
+    return True
+
+
+def download_once(url, path, session):
+    part_path = path + ".part"
+    headers = {}
+    if os.path.exists(path):
+        headers = conditional_headers(read_meta(path))
+    elif os.path.exists(part_path):
+        meta = read_meta(part_path)
+        validator = meta.get("etag") or meta.get("last_modified")
+        if validator:
+            # Only resume if the file on the server is still the one we started on
+            headers["Range"] = "bytes={}-".format(os.path.getsize(part_path))
+            headers["If-Range"] = validator
+
+    with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 304:
+            return 0
+        if r.status_code == 416:
+            # The partial download doesn't line up with the file any more
+            os.remove(part_path)
+            raise TransientDownloadError(r.status_code, r.reason)
+        if r.status_code in RETRY_STATUSES:
+            raise TransientDownloadError(r.status_code, r.reason)
+        if r.status_code not in [200, 206]:
+            raise DownloadError(r.status_code, r.reason)
+
+        # Keep the validators so that an interrupted download can be resumed
+        write_meta(part_path, response_meta(r))
+        transferred = 0
+        with open(part_path, "ab" if r.status_code == 206 else "wb") as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                transferred += len(chunk)
+
+    os.replace(part_path, path)
+    os.replace(part_path + ".meta", path + ".meta")
+    return transferred
+
+
+def download_to_buffer_once(url, buffer, session, meta=None):
+    buffer.seek(0)
+    buffer.truncate()
+    headers = conditional_headers(meta) if meta else {}
+    with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 304:
+            return 0
+        if r.status_code in RETRY_STATUSES:
+            raise TransientDownloadError(r.status_code, r.reason)
+        if r.status_code != 200:
+            raise DownloadError(r.status_code, r.reason)
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+        # Only once it's all here, so a retry doesn't ask if this copy has changed
+        if meta is not None:
+            meta.update(response_meta(r))
+    transferred = buffer.tell()
+    buffer.seek(0)
+    return transferred
+
+
+def get_report_dates(start, end):
+    """Gets every weekday from start to end, inclusive; no data is published on
+    weekends."""
+    dates = []
+    d = start
+    while d <= end:
+        if d.weekday() <= 4:
+            dates.append(d)
+        d = d + timedelta(days=1)
+    return dates
+
+
+def backfill(start, end, directory=BACKFILL_DIR, concurrency=BACKFILL_CONCURRENCY):
+    """Downloads the raw data for every report date from start to end into directory,
+    a few at a time, skipping any that have already been downloaded."""
+    os.makedirs(directory, exist_ok=True)
+    session = make_session(concurrency)
+
+    def fetch(d):
+        url_date = d.strftime(URL_DATE_FMT).lower()
+        path = os.path.join(directory, url_date + ".xlsx")
+        if os.path.exists(path):
+            print("{}: already downloaded".format(path))
+            return
+        started = time.perf_counter()
+        try:
+            transferred = download(URL.format(url_date), path, session)
+        except DownloadError as e:
+            print("{}: failed ({} {})".format(path, e.status_code, e.reason))
+            return
+        except requests.RequestException as e:
+            # A connection error or timeout that was still failing after the retries
+            print("{}: failed ({})".format(path, e))
+            return
+        elapsed = time.perf_counter() - started
+        print(
+            "{}: {:,.1f} KB in {:.2f}s ({:,.1f} KB/s)".format(
+                path, transferred / 1024, elapsed, transferred / 1024 / elapsed
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fetch, get_report_dates(start, end)))
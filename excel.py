@@ -18,37 +18,548 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from openpyxl import load_workbook
+import hashlib
+import pickle
+import posixpath
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import repeat
+from xml.etree.ElementTree import fromstring, iterparse
 
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+OFFICE_DOCUMENT_REL = (
+    "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+)
 
-def get_excel_data_for_date_range(filename, date_range, sheetname=None):
+WINDOWS_EPOCH = datetime(1899, 12, 30)
+MAC_EPOCH = datetime(1904, 1, 1)
+BUILTIN_DATE_FORMATS = {14, 15, 16, 17, 18, 19, 20, 21, 22, 45, 46, 47}
+BUILTIN_TIMEDELTA_FORMATS = {46}
+# Quoted text and bracketed locale/colour codes don't count towards a format being a
+# date format, but elapsed-time brackets like [h] do
+FORMAT_STRIP_RE = re.compile(r'".*?"|\[(?!hh?\]|mm?\]|ss?\])[^\]]*\]')
+DATE_FORMAT_RE = re.compile(r"(?<![_\\])[dmhysDMHYS]")
+TIMEDELTA_FORMAT_RE = re.compile(
+    r"\[hh?\](:mm(:ss(\.0*)?)?)?|\[mm?\](:ss(\.0*)?)?|\[ss?\](\.0*)?", re.I
+)
+
+
+class Sheet:
+    """The rows of a single sheet, read from the workbook as they're needed. The MDPH
+    sheets are sorted by date, so a lookup can stop reading once it has passed the last
+    date it cares about, and the next lookup picks up where the last one left off.
+
+    Rows are indexed by the date in their first column as they're read; rows without a
+    date (blank rows, footnotes) are dropped. Reads are locked, so a sheet can be looked
+    up from more than one thread."""
+
+    def __init__(self, rows):
+        self._lock = threading.Lock()
+        self._rows = rows
+        self.headings = list(next(rows, ()))
+        self.rows = []
+        self.dates = []
+        self.index = {}
+
+    @property
+    def complete(self):
+        return self._rows is None
+
+    @property
+    def last_date(self):
+        return self.dates[-1] if self.dates else None
+
+    def read_through(self, last_date=None):
+        """Reads rows until we've passed last_date, or to the end of the sheet if no
+        date is given."""
+        if self._rows is None:
+            return
+        with self._lock:
+            self._read_through(last_date)
+
+    def _read_through(self, last_date):
+        if self._rows is None:
+            return
+        if last_date and self.last_date and self.last_date > last_date:
+            return
+        for row in self._rows:
+            dt = row[0] if row else None
+            if dt:
+                d = dt.date()
+                # Where a date appears more than once, the last row for it wins
+                self.index[d] = len(self.rows)
+                self.rows.append(row)
+                self.dates.append(d)
+                if last_date and d > last_date:
+                    return
+        self._rows = None
+
+    def rows_between(self, start, end):
+        """Gets every row dated between start and end, inclusive, in sheet order."""
+        self.read_through(end)
+        return self.rows[bisect_left(self.dates, start) : bisect_right(self.dates, end)]
+
+    def as_dict(self, row):
+        return {x: row[h_ind] for h_ind, x in enumerate(self.headings)}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Makes a complete sheet from a list of rows, headings first."""
+        sheet = cls(iter(rows))
+        sheet.read_through()
+        return sheet
+
+
+class OpenpyxlReader:
+    """Reads sheet values through openpyxl's read-only mode."""
+
+    def __init__(self, filename):
+        # openpyxl takes a while to import, and isn't needed when reading the XML
+        # directly or when every sheet comes from the cache
+        from openpyxl import load_workbook
+
+        self._workbook = load_workbook(
+            filename=filename, read_only=True, data_only=True
+        )
+        self.sheetnames = self._workbook.sheetnames
+
+    def close(self):
+        self._workbook.close()
+
+    def rows(self, sheetname):
+        return self._workbook[sheetname].iter_rows(values_only=True)
+
+
+class XlsxReader:
+    """Reads sheet values straight out of the xlsx file's XML, skipping openpyxl's cell
+    objects and styles. Values come out the same as openpyxl's values-only rows: numbers
+    in date formats become datetimes, shared strings are resolved, and each row is
+    padded out to the sheet's width."""
+
+    def __init__(self, filename):
+        self._zip = zipfile.ZipFile(filename)
+        package_rels = fromstring(self._zip.read("_rels/.rels"))
+        workbook_path = next(
+            rel.get("Target").lstrip("/")
+            for rel in package_rels.iter(PKG_REL_NS + "Relationship")
+            if rel.get("Type") == OFFICE_DOCUMENT_REL
+        )
+        workbook_dir, workbook_file = posixpath.split(workbook_path)
+        workbook = fromstring(self._zip.read(workbook_path))
+        self._targets = self._read_rels(
+            posixpath.join(workbook_dir, "_rels", workbook_file + ".rels"), workbook_dir
+        )
+
+        self._sheet_paths = {}
+        for sheet in workbook.iter(MAIN_NS + "sheet"):
+            self._sheet_paths[sheet.get("name")] = self._targets[
+                sheet.get(REL_NS + "id")
+            ]
+        self.sheetnames = list(self._sheet_paths)
+
+        properties = workbook.find(MAIN_NS + "workbookPr")
+        self.epoch = WINDOWS_EPOCH
+        if properties is not None and properties.get("date1904") in ["1", "true"]:
+            self.epoch = MAC_EPOCH
+
+        self._shared_strings = self._read_shared_strings()
+        self._date_styles, self._timedelta_styles = self._read_styles()
+
+    def close(self):
+        self._zip.close()
+
+    def _read_rels(self, path, base_dir):
+        targets = {}
+        for rel in fromstring(self._zip.read(path)).iter(PKG_REL_NS + "Relationship"):
+            target = rel.get("Target")
+            if target.startswith("/"):
+                targets[rel.get("Id")] = target.lstrip("/")
+            else:
+                targets[rel.get("Id")] = posixpath.normpath(
+                    posixpath.join(base_dir, target)
+                )
+        return targets
+
+    def _find_part(self, name):
+        return next((p for p in self._targets.values() if p.endswith(name)), None)
+
+    def _read_shared_strings(self):
+        path = self._find_part("sharedStrings.xml")
+        if path is None:
+            return []
+        strings = []
+        with self._zip.open(path) as source:
+            for _, element in iterparse(source):
+                if element.tag == MAIN_NS + "si":
+                    strings.append(text_content(element))
+                    element.clear()
+        return strings
+
+    def _read_styles(self):
+        path = self._find_part("styles.xml")
+        if path is None:
+            return set(), set()
+        styles = fromstring(self._zip.read(path))
+        custom = {
+            int(fmt.get("numFmtId")): fmt.get("formatCode")
+            for fmt in styles.iter(MAIN_NS + "numFmt")
+        }
+        date_styles = set()
+        timedelta_styles = set()
+        cell_xfs = styles.find(MAIN_NS + "cellXfs")
+        for ind, xf in enumerate(cell_xfs if cell_xfs is not None else []):
+            fmt_id = int(xf.get("numFmtId", 0))
+            if fmt_id in custom:
+                code = FORMAT_STRIP_RE.sub("", custom[fmt_id].split(";")[0])
+                if DATE_FORMAT_RE.search(code):
+                    date_styles.add(ind)
+                if TIMEDELTA_FORMAT_RE.search(custom[fmt_id]):
+                    timedelta_styles.add(ind)
+            elif fmt_id in BUILTIN_DATE_FORMATS:
+                date_styles.add(ind)
+                if fmt_id in BUILTIN_TIMEDELTA_FORMATS:
+                    timedelta_styles.add(ind)
+        return date_styles, timedelta_styles
+
+    def rows(self, sheetname):
+        with self._zip.open(self._sheet_paths[sheetname]) as source:
+            width = None
+            counter = 0
+            for _, element in iterparse(source):
+                if element.tag == MAIN_NS + "dimension":
+                    last_cell = element.get("ref").split(":")[-1]
+                    width = column_index(last_cell)
+                elif element.tag == MAIN_NS + "row":
+                    ind = int(element.get("r", counter + 1))
+                    # Rows with nothing in them may be left out of the file entirely
+                    while counter + 1 < ind:
+                        counter += 1
+                        yield (None,) * width if width else ()
+                    counter = ind
+                    yield self._parse_row(element, width)
+                    element.clear()
+
+    def _parse_row(self, element, width):
+        cells = {}
+        col = 0
+        for cell in element.iter(MAIN_NS + "c"):
+            ref = cell.get("r")
+            col = column_index(ref) if ref else col + 1
+            cells[col] = self._parse_cell(cell)
+        width = width or col
+        values = [None] * width
+        for col, value in cells.items():
+            if col <= width:
+                values[col - 1] = value
+        return tuple(values)
+
+    def _parse_cell(self, cell):
+        data_type = cell.get("t", "n")
+        if data_type == "inlineStr":
+            inline = cell.find(MAIN_NS + "is")
+            return text_content(inline) if inline is not None else None
+
+        value = cell.findtext(MAIN_NS + "v") or None
+        if value is None:
+            return None
+        if data_type == "n":
+            if "." in value or "E" in value or "e" in value:
+                value = float(value)
+            else:
+                value = int(value)
+            style = int(cell.get("s", 0))
+            if style in self._date_styles:
+                try:
+                    return from_excel(
+                        value, self.epoch, style in self._timedelta_styles
+                    )
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return value
+        if data_type == "s":
+            return self._shared_strings[int(value)]
+        if data_type == "b":
+            return bool(int(value))
+        if data_type == "d":
+            return datetime.fromisoformat(value)
+        return value
+
+
+READERS = {"openpyxl": OpenpyxlReader, "xml": XlsxReader}
+
+
+def column_index(ref):
+    """Gets the 1-based column number of a cell reference like "AB12"."""
+    ind = 0
+    for char in ref:
+        if char.isdigit():
+            break
+        ind = ind * 26 + ord(char.upper()) - ord("A") + 1
+    return ind
+
+
+def text_content(element):
+    """Gets the plain text of a shared or inline string, leaving out phonetic runs."""
+    text = []
+    for child in element:
+        if child.tag == MAIN_NS + "t":
+            text.append(child.text or "")
+        elif child.tag == MAIN_NS + "r":
+            text.append(child.findtext(MAIN_NS + "t") or "")
+    return "".join(text)
+
+
+def from_excel(value, epoch, is_timedelta=False):
+    """Converts an Excel serial date to a datetime, the same way openpyxl does."""
+    if is_timedelta:
+        td = timedelta(days=value)
+        if td.microseconds:
+            td = timedelta(
+                seconds=td.total_seconds() // 1,
+                microseconds=round(td.microseconds, -3),
+            )
+        return td
+
+    day, fraction = divmod(value, 1)
+    diff = timedelta(milliseconds=round(fraction * 86400 * 1000))
+    if 0 <= value < 1 and diff.days == 0:
+        return (datetime.min + diff).time()
+    # Excel thinks 1900 was a leap year, so serials before March 1, 1900 are a day off
+    if 0 < value < 60 and epoch == WINDOWS_EPOCH:
+        day += 1
+    return epoch + timedelta(days=day) + diff
+
+
+class SheetCache:
+    """An SQLite store of parsed sheets, keyed by the SHA-256 of the workbook they came
+    from, so rerunning on a workbook we've already seen doesn't have to parse it again.
+    Once the store grows past max_bytes, the least recently used sheets are evicted."""
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        # The cache can be shared between threads, so the connection is locked
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sheets (digest TEXT, sheetname TEXT, rows BLOB, "
+            "size INTEGER, last_used REAL, PRIMARY KEY (digest, sheetname))"
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, digest, sheetname):
+        """Gets the rows of a cached sheet (headings first), or None if we don't have
+        it."""
+        with self._lock:
+            found = self._db.execute(
+                "SELECT rows FROM sheets WHERE digest = ? AND sheetname = ?",
+                (digest, sheetname),
+            ).fetchone()
+            if found is None:
+                return None
+            with self._db:
+                self._db.execute(
+                    "UPDATE sheets SET last_used = ? WHERE digest = ? AND sheetname = ?",
+                    (time.time(), digest, sheetname),
+                )
+        return pickle.loads(found[0])
+
+    def put(self, digest, sheetname, rows):
+        blob = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?, ?)",
+                (digest, sheetname, blob, len(blob), time.time()),
+            )
+            self._evict()
+
+    def _evict(self):
+        total = 0
+        entries = self._db.execute(
+            "SELECT digest, sheetname, size FROM sheets ORDER BY last_used DESC"
+        ).fetchall()
+        for digest, sheetname, size in entries:
+            total += size
+            if total > self.max_bytes:
+                self._db.execute(
+                    "DELETE FROM sheets WHERE digest = ? AND sheetname = ?",
+                    (digest, sheetname),
+                )
+
+
+class WorkbookSession:
+    """A raw-data workbook that is opened once and shared by all of the generators in a
+    run. Each sheet is parsed at most once, and the parsed rows are kept so later
+    lookups on the same sheet don't go back to the file.
+
+    In streaming mode (the default) sheets are only read as far as the latest date
+    that's been asked for; otherwise each sheet is read in full when it's opened. If a
+    SheetCache is passed in, sheets are looked up there before the workbook is opened,
+    and sheets that have to be parsed are read in full and saved to it. The reader is
+    one of the keys of READERS.
+
+    The filename can also be a binary file object, like a BytesIO holding a workbook
+    that was downloaded into memory; the readers read from it in place.
+
+    A session can be shared between threads. Opening and loading sheets is locked, so
+    each sheet is still only parsed once."""
+
+    def __init__(self, filename, streaming=True, cache=None, reader="openpyxl"):
+        self.filename = filename
+        self.streaming = streaming
+        self.cache = cache
+        self.reader = reader
+        self._workbook = None
+        self._digest = None
+        self._sheets = {}
+        self._tables = {}
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._workbook is not None:
+                self._workbook.close()
+                self._workbook = None
+                # Sheets that were only partially read can't be resumed once the file
+                # is closed, so they'll have to be read again if they're needed.
+                self._sheets = {k: v for k, v in self._sheets.items() if v.complete}
+
+    @property
+    def digest(self):
+        """The SHA-256 of the workbook file."""
+        if self._digest is None:
+            sha = hashlib.sha256()
+            if hasattr(self.filename, "getbuffer"):
+                with self.filename.getbuffer() as view:
+                    sha.update(view)
+            else:
+                with open(self.filename, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        sha.update(chunk)
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def _open(self):
+        with self._lock:
+            if self._workbook is None:
+                self._workbook = READERS[self.reader](self.filename)
+            return self._workbook
+
+    def get_sheet(self, sheetname=None):
+        """Gets a sheet by name. If sheet name isn't passed in, assume we're looking at
+        the first sheet."""
+        with self._lock:
+            if not sheetname:
+                sheetname = self._open().sheetnames[0]
+            if sheetname not in self._sheets:
+                self._sheets[sheetname] = self._load_sheet(sheetname)
+            return self._sheets[sheetname]
+
+    def get_table(self, sheetname):
+        """Gets every row of a sheet that isn't organized by date, headings first."""
+        with self._lock:
+            if sheetname not in self._tables:
+                self._tables[sheetname] = list(self._open().rows(sheetname))
+            return self._tables[sheetname]
+
+    def rows_read(self):
+        """The number of rows read so far from each sheet that's been opened."""
+        counts = {name: len(sheet.rows) for name, sheet in self._sheets.items()}
+        counts.update({name: len(rows) for name, rows in self._tables.items()})
+        return counts
+
+    def preload(self, sheetnames, workers):
+        """Reads the given sheets in full ahead of time, spreading the ones that aren't
+        already loaded or cached across a pool of worker processes."""
+        with self._lock:
+            self._preload(sheetnames, workers)
+
+    def _preload(self, sheetnames, workers):
+        pending = []
+        for sheetname in sheetnames:
+            if sheetname in self._sheets:
+                continue
+            rows = self.cache.get(self.digest, sheetname) if self.cache else None
+            if rows is not None:
+                self._sheets[sheetname] = Sheet.from_rows(rows)
+            else:
+                pending.append(sheetname)
+        if not pending:
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(
+                read_sheet, repeat(self.filename), pending, repeat(self.reader)
+            )
+            for sheetname, rows in zip(pending, results):
+                self._sheets[sheetname] = Sheet.from_rows(rows)
+                if self.cache:
+                    self.cache.put(self.digest, sheetname, rows)
+
+    def _load_sheet(self, sheetname):
+        if self.cache:
+            rows = self.cache.get(self.digest, sheetname)
+            if rows is not None:
+                return Sheet.from_rows(rows)
+
+        sheet = Sheet(self._open().rows(sheetname))
+        if self.cache:
+            sheet.read_through()
+            self.cache.put(self.digest, sheetname, [sheet.headings] + sheet.rows)
+        elif not self.streaming:
+            sheet.read_through()
+        return sheet
+
+
+def read_sheet(filename, sheetname, reader="openpyxl"):
+    """Reads a whole sheet from a workbook file, returning its rows with the headings
+    first. This runs in worker processes, so it opens the file itself."""
+    wb = READERS[reader](filename)
+    try:
+        sheet = Sheet(wb.rows(sheetname))
+        sheet.read_through()
+        return [sheet.headings] + sheet.rows
+    finally:
+        wb.close()
+
+
+def get_excel_data_for_date_range(workbook, date_range, sheetname=None):
     """Gets the rows for the selected date range, represented as a dict. This makes some
     assumptions about the format of the Excel sheet, including that the first row is
-    the header row and that the first column contains the dates."""
-    wb = load_workbook(filename=filename, data_only=True)
-
-    # If sheet name isn't passed in, assume we're looking at the first sheet
-    if not sheetname:
-        sheets = wb.sheetnames
-        sheetname = sheets[0]
-    sheet = wb[sheetname]
-
-    headings = []
-    result = {d: None for d in date_range}
-
-    for ind, row in enumerate(sheet.rows):
-        if ind == 0:
-            headings = [x.value for x in row]
-        else:
-            dt = row[0].value
-            if dt and dt.date() in date_range:
-                result[dt.date()] = {
-                    x: row[h_ind].value for h_ind, x in enumerate(headings)
-                }
-
+    the header row, that the first column contains the dates, and that the rows are
+    sorted by date."""
+    sheet = workbook.get_sheet(sheetname)
+    sheet.read_through(max(date_range))
+    result = {}
+    for d in date_range:
+        ind = sheet.index.get(d)
+        result[d] = sheet.as_dict(sheet.rows[ind]) if ind is not None else None
     return result
 
 
+def get_excel_data_between(workbook, start, end, sheetname=None):
+    """Like get_excel_data_for_date_range, but for every date from start to end
+    (inclusive) that has a row in the sheet."""
+    sheet = workbook.get_sheet(sheetname)
+    return {row[0].date(): sheet.as_dict(row) for row in sheet.rows_between(start, end)}
+
+
 def safe_lookup(excel_dict, key, default=None):
     if type(excel_dict) is dict and key in excel_dict:
         try:
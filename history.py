@@ -0,0 +1,195 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import math
+import mmap
+import os
+import re
+from array import array
+from datetime import date
+
+from constants import *
+from cases_by_county_daily_table import get_county_matrix
+from excel import get_excel_data_between
+
+# The first day that any of the charts cover
+HISTORY_START = date(2020, 2, 26)
+
+# Metrics taken from each sheet. Each metric is the sum of the listed columns.
+HISTORY_METRICS = {
+    "Cases (Report Date)": {
+        "confirmed_cases": ["Positive Total"],
+        "probable_cases": ["Probable Total"],
+    },
+    "DeathsReported (Report Date)": {
+        "deaths": ["DeathsConfTotal", "DeathsProbTotal"],
+    },
+    "CasesByDate (Test Date)": {
+        "cases_by_test_date": ["Positive Total"],
+        "new_cases_by_test_date": ["Positive New"],
+        "rolling_avg_cases": ["7-day confirmed case average"],
+    },
+    "DateofDeath": {
+        "deaths_by_date": ["Confirmed Total"],
+        "new_deaths_by_date": ["Confirmed Deaths"],
+        "rolling_avg_deaths": ["7-day confirmed death average"],
+    },
+    "Hospitalization from Hospitals": {
+        "hosp_current": ["Total number of COVID patients in hospital today"],
+        "icu_current": ["ICU"],
+        "vent_current": ["Intubated"],
+    },
+}
+
+
+def day_index(d):
+    return (d - HISTORY_START).days
+
+
+class Column:
+    """The values of one metric, as one float64 per day since HISTORY_START, memory-
+    mapped from a file. Days without a value are NaN. The file only ever grows."""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._file = open(path, "r+b")
+        self._map()
+
+    def _map(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+            self._values = memoryview(self._mmap).cast("d")
+        else:
+            self._mmap = None
+            self._values = memoryview(b"").cast("d")
+
+    def _unmap(self):
+        self._values.release()
+        if self._mmap:
+            self._mmap.close()
+
+    def close(self):
+        self._unmap()
+        self._file.close()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, ind):
+        if 0 <= ind < len(self._values):
+            val = self._values[ind]
+            if not math.isnan(val):
+                return val
+        return None
+
+    def reserve(self, length):
+        """Grows the column to at least the given number of days."""
+        missing = length - len(self._values)
+        if missing > 0:
+            self._unmap()
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(array("d", [math.nan] * missing).tobytes())
+            self._file.flush()
+            self._map()
+
+    def set(self, ind, value):
+        """Sets the value for a day, returning whether anything changed."""
+        value = math.nan if value is None else float(value)
+        current = self.get(ind)
+        if current == value or (current is None and math.isnan(value)):
+            return False
+        self.reserve(ind + 1)
+        self._values[ind] = value
+        return True
+
+
+class HistoryStore:
+    """A persistent, column-per-metric store of the daily series we publish. Each
+    workbook repeats the whole history, but only the days that are new or have been
+    revised since the last run are written."""
+
+    def __init__(self, path=HISTORY_DIR):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for column in self._columns.values():
+            column.close()
+        self._columns = {}
+
+    def _column(self, metric):
+        if metric not in self._columns:
+            filename = re.sub(r"[^\w.-]+", "_", metric) + ".f8"
+            self._columns[metric] = Column(os.path.join(self.path, filename))
+        return self._columns[metric]
+
+    def get(self, metric, d):
+        """Gets the value of a metric for a date, or None if there isn't one."""
+        return self._column(metric).get(day_index(d))
+
+    def series(self, metric, dates):
+        column = self._column(metric)
+        return [column.get(day_index(d)) for d in dates]
+
+    def update(self, metric, values):
+        """Writes a dict of date -> value, returning the number of days changed."""
+        column = self._column(metric)
+        values = {day_index(d): val for d, val in values.items() if d >= HISTORY_START}
+        if values:
+            column.reserve(max(values) + 1)
+        return sum(column.set(ind, val) for ind, val in values.items())
+
+
+def sum_columns(row, headings):
+    vals = [row[h] for h in headings]
+    if any(v is None or isinstance(v, str) for v in vals):
+        return None
+    return sum(vals)
+
+
+def update_history(history, workbook, today):
+    """Copies every series we publish from the workbook into the history store,
+    returning the number of days that were added or changed."""
+    changed = 0
+    for sheetname, metrics in HISTORY_METRICS.items():
+        rows = get_excel_data_between(workbook, HISTORY_START, today, sheetname)
+        for metric, headings in metrics.items():
+            changed += history.update(
+                metric, {d: sum_columns(row, headings) for d, row in rows.items()}
+            )
+
+    counties = get_county_matrix(workbook, HISTORY_START, today)
+    dates = counties.dates
+    for (metric, county), series in counties.columns.items():
+        changed += history.update(
+            "county_{}.{}".format(metric, county), dict(zip(dates, series.values))
+        )
+
+    return changed
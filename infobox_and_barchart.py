@@ -19,68 +19,76 @@
 # SOFTWARE.
 
 import re
-import os
 from datetime import date, timedelta
 from constants import *
 from excel import get_excel_data_for_date_range
+from profiling import profiler
+from render import open_output
+from series import DailyFrame
 
+BAR_CHART_ROW = "{date};{deaths};;{conf};{prob};;{total:,};{sign}{change}"
 
-def get_data(xlsx_path, date_range, today):
-    prev_day = date_range[0] - timedelta(days=1)
-    today_str = today.strftime(DAY_FMT)
-    full_date_range = [prev_day] + date_range
-    data = {
-        d.strftime(DAY_FMT): {
-            "confirmed_cases": None,
-            "probable_cases": None,
-            "total_cases": None,
-            "deaths": None,
-        }
-        for d in full_date_range
-    }
 
+def get_excel_totals(data, workbook, full_date_range):
+    """Fills in the cumulative counts for each date from the workbook."""
     case_data = get_excel_data_for_date_range(
-        xlsx_path, full_date_range, "Cases (Report Date)"
+        workbook, full_date_range, "Cases (Report Date)"
     )
     for date, row in case_data.items():
-        date_str = date.strftime(DAY_FMT)
-        data[date_str] = {
-            "confirmed_cases": None,
-            "probable_cases": None,
-            "total_cases": None,
-        }
         if row:
             confirmed = int(row["Positive Total"])
             probable = int(row["Probable Total"])
-            data[date_str] = {
-                "confirmed_cases": confirmed,
-                "probable_cases": probable,
-                "total_cases": confirmed + probable,
-            }
+            data["confirmed_cases"][date] = confirmed
+            data["probable_cases"][date] = probable
+            data["total_cases"][date] = confirmed + probable
 
     deaths_data = get_excel_data_for_date_range(
-        xlsx_path, full_date_range, "DeathsReported (Report Date)"
+        workbook, full_date_range, "DeathsReported (Report Date)"
     )
     for date, row in deaths_data.items():
-        date_str = date.strftime(DAY_FMT)
         if row:
-            data[date_str]["deaths"] = int(row["DeathsConfTotal"]) + int(
+            data["deaths"][date] = int(row["DeathsConfTotal"]) + int(
                 row["DeathsProbTotal"]
             )
-        else:
-            data[date_str]["deaths"] = None
+
+
+def get_history_totals(data, history, full_date_range):
+    """Fills in the cumulative counts for each date from the history store."""
+    for d in full_date_range:
+        confirmed = history.get("confirmed_cases", d)
+        probable = history.get("probable_cases", d)
+        deaths = history.get("deaths", d)
+        if deaths is not None:
+            data["deaths"][d] = int(deaths)
+        if confirmed is not None and probable is not None:
+            data["confirmed_cases"][d] = int(confirmed)
+            data["probable_cases"][d] = int(probable)
+            data["total_cases"][d] = int(confirmed) + int(probable)
+
+
+def get_data(workbook, date_range, today, history=None):
+    prev_day = date_range[0] - timedelta(days=1)
+    full_date_range = [prev_day] + date_range
+    data = DailyFrame.over(full_date_range)
+    for column in ["confirmed_cases", "probable_cases", "total_cases", "deaths"]:
+        data.add(column)
+
+    if history:
+        get_history_totals(data, history, full_date_range)
+    else:
+        get_excel_totals(data, workbook, full_date_range)
 
     # Additional data for today only, for use in the article body
     testing_data = get_excel_data_for_date_range(
-        xlsx_path, [today], "Testing2 (Report Date)"
+        workbook, [today], "Testing2 (Report Date)"
     )
-    data[today_str]["total_molecular_tests"] = int(
+    data.add("total_molecular_tests")[today] = int(
         testing_data[today]["Molecular All Tests Total"]
     )
-    data[today_str]["individual_molecular_tests"] = int(
+    data.add("individual_molecular_tests")[today] = int(
         testing_data[today]["Molecular Total"]
     )
-    data[today_str]["antigen_tests"] = int(testing_data[today]["Antigen Total"])
+    data.add("antigen_tests")[today] = int(testing_data[today]["Antigen Total"])
 
     # For hospitalizations and rolling averages, the data from previous days is the most
     # recent
@@ -88,34 +96,33 @@ def get_data(xlsx_path, date_range, today):
     day_before_yesterday = today - timedelta(days=2)
 
     case_data = get_excel_data_for_date_range(
-        xlsx_path, [yesterday], "CasesByDate (Test Date)"
+        workbook, [yesterday], "CasesByDate (Test Date)"
     )
-    data[today_str]["rolling_avg_cases"] = int(
+    data.add("rolling_avg_cases")[today] = int(
         round(case_data[yesterday]["7-day confirmed case average"])
     )
 
     death_data = get_excel_data_for_date_range(
-        xlsx_path, [day_before_yesterday], "DateofDeath"
+        workbook, [day_before_yesterday], "DateofDeath"
     )
-    data[today_str]["rolling_avg_deaths"] = int(
+    data.add("rolling_avg_deaths")[today] = int(
         round(death_data[day_before_yesterday]["7-day confirmed death average"])
     )
 
     hosp_data = get_excel_data_for_date_range(
-        xlsx_path, [yesterday], "Hospitalization from Hospitals"
+        workbook, [yesterday], "Hospitalization from Hospitals"
     )
-    data[today_str]["hosp_current"] = hosp_data[yesterday][
+    data.add("hosp_current")[today] = hosp_data[yesterday][
         "Total number of COVID patients in hospital today"
     ]
-    data[today_str]["icu_current"] = hosp_data[yesterday]["ICU"]
-    data[today_str]["vent_current"] = hosp_data[yesterday]["Intubated"]
+    data.add("icu_current")[today] = hosp_data[yesterday]["ICU"]
+    data.add("vent_current")[today] = hosp_data[yesterday]["Intubated"]
 
     return data
 
 
 def create_infobox(data, today, manual_data):
     lines = []
-    today_str = today.strftime(DAY_FMT)
     today_citation = today.strftime(CITATION_DATE_FORMAT)
     asof = "{{{{as of|{}|alt=as of {}}}}}".format(
         today.strftime("%Y|%m|%d"), today.strftime(AS_OF_ALT_FMT)
@@ -138,32 +145,32 @@ def create_infobox(data, today, manual_data):
         " title = COVID-19 Response Reporting | url = https://www.mass.gov/info-details"
         "/covid-19-response-reporting | website = Massachusetts Department of Public "
         "Health | access-date = {}}}}}</ref>".format(
-            data[today_str]["confirmed_cases"],
+            data["confirmed_cases"][today],
             asof,
             today_citation,
         )
     )
     lines.append(
         '| hospitalized_cases = {:,} (current) {}<ref name="MDPH-Cases"/>'.format(
-            data[today_str]["hosp_current"],
+            data["hosp_current"][today],
             asof,
         )
     )
     lines.append(
         '| critical_cases    = {:,} (current) {}<ref name="MDPH-Cases"/>'.format(
-            data[today_str]["icu_current"],
+            data["icu_current"][today],
             asof,
         )
     )
     lines.append(
         '| ventilator_cases  = {:,} (current) {}<ref name="MDPH-Cases"/>'.format(
-            data[today_str]["vent_current"],
+            data["vent_current"][today],
             asof,
         )
     )
     lines.append(
         '| deaths            = {:,} (cumulative) {}<ref name="MDPH-Cases"/>'.format(
-            data[today_str]["deaths"], asof
+            data["deaths"][today], asof
         )
     )
     lines.append(
@@ -185,62 +192,78 @@ def create_infobox(data, today, manual_data):
 
 
 def find_previous_total_cases(data, date):
-    offset = 1
-    prev_day = (date - timedelta(days=offset)).strftime(DAY_FMT)
-    while prev_day in data:
-        if data[prev_day]["total_cases"] is not None:
-            return data[prev_day]["total_cases"]
-        else:
-            offset += 1
-            prev_day = (date - timedelta(days=offset)).strftime(DAY_FMT)
+    totals = data["total_cases"].values
+    ind = data["total_cases"].index(date) - 1
+    while ind >= 0:
+        if totals[ind] is not None:
+            return totals[ind]
+        ind -= 1
     return None
 
 
-def create_bar_chart(data, date_range):
+def create_bar_chart_row(date, deaths, confirmed, probable, total, previous_total):
+    if total is not None and previous_total is not None:
+        perc_case_change = ((total - previous_total) / previous_total) * 100
+        perc_case_change_str = "{:.2f}%".format(perc_case_change)
+    else:
+        perc_case_change_str = "n/a"
+    sign = "" if perc_case_change_str == "n/a" or perc_case_change < 0 else "+"
+    return BAR_CHART_ROW.format(
+        date=date.strftime(BAR_CHART_FMT),
+        deaths=deaths,
+        conf=confirmed,
+        prob=probable,
+        total=total,
+        sign=sign,
+        change=perc_case_change_str,
+    )
+
+
+def create_bar_chart(data, date_range, state=None):
+    """Renders the bar chart rows. With a render state, only the rows whose values have
+    changed since the last run are rendered again."""
     rows = []
+    confirmed_cases = data["confirmed_cases"]
+    probable_cases = data["probable_cases"]
+    total_cases = data["total_cases"]
+    deaths = data["deaths"]
+    # The most recent total before each date is carried forward as we go, rather than
+    # searched for again for every date
+    previous_total_cases = find_previous_total_cases(data, date_range[0])
     for date in date_range:
-        date_str = date.strftime(DAY_FMT)
-
-        previous_total_cases = find_previous_total_cases(data, date)
-        if (
-            data[date_str]["total_cases"] is not None
-            and previous_total_cases is not None
-        ):
-            perc_case_change = (
-                (data[date_str]["total_cases"] - previous_total_cases)
-                / previous_total_cases
-            ) * 100
-            perc_case_change_str = "{:.2f}%".format(perc_case_change)
-        else:
-            perc_case_change_str = "n/a"
-
-        if data[date_str]["confirmed_cases"] is not None:
-            sign = "" if perc_case_change_str == "n/a" or perc_case_change < 0 else "+"
-            row = "{date};{deaths};;{conf};{prob};;{total:,};{sign}{change}".format(
-                date=date.strftime(BAR_CHART_FMT),
-                deaths=data[date_str]["deaths"],
-                conf=data[date_str]["confirmed_cases"],
-                prob=data[date_str]["probable_cases"],
-                total=data[date_str]["total_cases"],
-                sign=sign,
-                change=perc_case_change_str,
+        total = total_cases[date]
+        if confirmed_cases[date] is not None:
+            rows.append(
+                (
+                    date,
+                    deaths[date],
+                    confirmed_cases[date],
+                    probable_cases[date],
+                    total,
+                    previous_total_cases,
+                )
             )
-            rows.append(row)
-    return "\n".join(rows)
+        if total is not None:
+            previous_total_cases = total
+
+    if state:
+        return state.join(
+            "bar_chart", rows, lambda row: create_bar_chart_row(*row), "\n"
+        )
+    return "\n".join([create_bar_chart_row(*row) for row in rows])
 
 
 def get_addl_info(data, url, today, manual_data):
-    today_str = today.strftime(DAY_FMT)
     today_citation_fmt = today.strftime(CITATION_DATE_FORMAT)
-    addl = "Total cases: {:,}".format(data[today_str]["total_cases"])
+    addl = "Total cases: {:,}".format(data["total_cases"][today])
     addl += "\nLatest rolling averages (prev day for cases, 2 days ago for deaths):"
-    addl += "\n\tConfirmed cases: {:,}".format(data[today_str]["rolling_avg_cases"])
-    addl += "\n\tConfirmed deaths: {:,}".format(data[today_str]["rolling_avg_deaths"])
+    addl += "\n\tConfirmed cases: {:,}".format(data["rolling_avg_cases"][today])
+    addl += "\n\tConfirmed deaths: {:,}".format(data["rolling_avg_deaths"][today])
     addl += "\n\nTests:\n\tMolecular: {:,} tests on {:,} individuals".format(
-        data[today_str]["total_molecular_tests"],
-        data[today_str]["individual_molecular_tests"],
+        data["total_molecular_tests"][today],
+        data["individual_molecular_tests"][today],
     )
-    addl += "\n\tAntigen: {:,}".format(data[today_str]["antigen_tests"])
+    addl += "\n\tAntigen: {:,}".format(data["antigen_tests"][today])
     addl += (
         '\n\n<ref name="MDPH-current-day">{{{{Cite web|url={url}|title=COVID-19 Raw '
         "Data - {cite_date}|date={cite_date}|website=Massachusetts Department of "
@@ -259,13 +282,21 @@ def get_addl_info(data, url, today, manual_data):
 
 
 def write_file(infobox, bar_chart, addl_info_for_article_body):
-    with open(os.path.join(OUT_DIR, "infobox_and_barchart.txt"), "w+") as f:
-        f.write(infobox + "\n\n\n" + bar_chart + "\n\n\n" + addl_info_for_article_body)
+    with open_output("infobox_and_barchart.txt") as f:
+        f.write(infobox)
+        f.write("\n\n\n")
+        f.write(bar_chart)
+        f.write("\n\n\n")
+        f.write(addl_info_for_article_body)
 
 
 def parse_vax_row(prompt):
-    inp = input(prompt)
-    result = re.search(r"([\d,]+).*?([\d\.%]+)", inp)
+    return parse_vax(input(prompt))
+
+
+def parse_vax(text):
+    """Parses a count and a percentage, like "4,800,123 (69.1%)"."""
+    result = re.search(r"([\d,]+).*?([\d\.%]+)", text)
     if result:
         num = result.group(1)
         perc = result.group(2)
@@ -292,10 +323,19 @@ def get_manual_data():
     }
 
 
-def create_infobox_and_barchart(xlsx_path, url, today, date_range, args):
-    data = get_data(xlsx_path, date_range, today)
-    manual_data = get_manual_data()
-    infobox = create_infobox(data, today, manual_data)
-    bar_chart = create_bar_chart(data, date_range)
-    addl_info_for_article_body = get_addl_info(data, url, today, manual_data)
-    write_file(infobox, bar_chart, addl_info_for_article_body)
+def create_infobox_and_barchart(
+    workbook, url, today, date_range, args, history=None, state=None, manual_data=None
+):
+    """Writes the infobox, bar chart and additional info. The manual data is asked for
+    here unless it's passed in."""
+    with profiler.stage("get_data"):
+        data = get_data(workbook, date_range, today, history)
+    if manual_data is None:
+        with profiler.stage("manual_input"):
+            manual_data = get_manual_data()
+    with profiler.stage("render"):
+        infobox = create_infobox(data, today, manual_data)
+        bar_chart = create_bar_chart(data, date_range, state)
+        addl_info_for_article_body = get_addl_info(data, url, today, manual_data)
+    with profiler.stage("write"):
+        write_file(infobox, bar_chart, addl_info_for_article_body)
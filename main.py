@@ -19,30 +19,154 @@
 # SOFTWARE.
 
 import argparse
+import io
 import os
-import requests
+import time
+import traceback
+from contextlib import closing
 from datetime import date, timedelta
 
 from constants import *
+from excel import READERS, SheetCache, WorkbookSession
+from profiling import profiler
+from render import RenderState
+from scheduler import Scheduler
 
-from infobox_and_barchart import create_infobox_and_barchart
-from cases_by_county_daily_table import create_daily_county_table
-from statistics import create_statistics_graphs
+# The generators, the history store and the downloader (and with it, requests) are
+# imported as they're needed, so that a run of only some of the stages doesn't pay to
+# import the rest.
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--no-manual",
-        help="skip manually inputting extra data (will result in placeholders in output"
-        + "files that will need to be replaced)",
+        help="don't prompt for the vaccination data. Unless it's given with --vax, "
+        "--manual-file or --cdc-report, the values from the last run are reused, or "
+        "placeholders are written if there weren't any",
         action="store_true",
     )
+    parser.add_argument(
+        "--vax",
+        nargs=3,
+        metavar=("ONE_DOSE", "FULLY_VACCINATED", "AS_OF"),
+        help='the vaccination data, instead of prompting for it, e.g. "4,800,123 '
+        '(69.1%%)" "4,300,000 (62.4%%)" 2021-09-08',
+    )
+    parser.add_argument(
+        "--manual-file",
+        help="read the vaccination data from a JSON (or, with PyYAML installed, YAML) "
+        "file with one_dose, fully_vaccinated and as_of fields, written like --vax",
+    )
+    parser.add_argument(
+        "--cdc-report",
+        help="read the vaccination data from a copy of the CDC's state profile report "
+        "saved as text or HTML",
+    )
     parser.add_argument(
         "--dev",
         help="developer mode, avoids making HTTP requests when possible",
         action="store_true",
     )
+    parser.add_argument(
+        "--no-cache",
+        help="don't read or write the cache of parsed sheets kept in the tmp directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--history",
+        help="add this workbook's data to the history store, and read the charts' "
+        "series from there",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only render the chart rows that are new or have changed since the last "
+        "run, reusing the rest from the render state kept in the tmp directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        help="record the time, CPU time and peak memory of each stage of the run, and "
+        "write them to a JSON report in the output directory. Tracing memory makes "
+        "the run slower",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-stats",
+        help="with --profile, also write the cProfile statistics of the slowest stage "
+        "that could be profiled. Only one stage at a time can be, so the report names "
+        "it as profiled_stage",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of processes to use to read the workbook's sheets in parallel",
+    )
+    parser.add_argument(
+        "--reader",
+        default="openpyxl",
+        choices=READERS.keys(),
+        help="how to read the workbook: through openpyxl, or by parsing its XML directly",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=STAGE_SHEETS.keys(),
+        help="only generate these outputs, leaving the rest of the output directory "
+        "as it is. The vaccination data is only asked for if the infobox is generated",
+    )
+    parser.add_argument(
+        "--towns",
+        help="also roll up the city/town sheet into per-county and statewide totals",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--in-memory",
+        help="download the workbook into memory and read it from there, without "
+        "writing it to the tmp directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-archive",
+        help="don't look for the workbook in the archive of earlier downloads, or add "
+        "it there",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--discard-saved",
+        help="throw away every copy we've kept of the workbook for the report date (in "
+        "the tmp directory, the archive and the backfill directory) and download it "
+        "afresh, like when a bad copy was kept",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch",
+        help="keep running, and generate each weekday's output as soon as its data is "
+        "published. The vaccination data isn't prompted for (see --no-manual)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=SERVER_PORT,
+        type=int,
+        metavar="PORT",
+        help="instead of generating output, serve each output and the series behind "
+        "them for any report date over HTTP on localhost (port {} by default)".format(
+            SERVER_PORT
+        ),
+    )
+    parser.add_argument(
+        "--backfill",
+        nargs=2,
+        metavar=("FROM", "TO"),
+        help="instead of generating output, download the raw data for every report "
+        "date from FROM to TO (inclusive) into the backfill directory. Format "
+        "YYYY-MM-DD.",
+    )
     parser.add_argument(
         "-fromdate",
         nargs="?",
@@ -72,58 +196,189 @@ def parse_args():
     args = parser.parse_args()
     dev = args.dev
     nomanual = args.no_manual
+    vax = args.vax
+    manual_file = args.manual_file
+    cdc_report = args.cdc_report
+    nocache = args.no_cache
+    history = args.history
+    incremental = args.incremental
+    profile = args.profile
+    profile_stats = args.profile_stats
+    workers = args.workers
+    reader = args.reader
+    towns = args.towns
+    watch = args.watch
+    in_memory = args.in_memory
+    noarchive = args.no_archive
+    discard_saved = args.discard_saved
+    serve = args.serve
+    only = args.only or list(STAGE_SHEETS.keys())
+    backfill_range = (
+        [date.fromisoformat(d) for d in args.backfill] if args.backfill else None
+    )
     today = args.date if isinstance(args.date, date) else date.fromisoformat(args.date)
     fromdate = date.fromisoformat(args.fromdate) if args.fromdate else None
     url = args.url
     return {
         "nomanual": nomanual,
+        "vax": vax,
+        "manual_file": manual_file,
+        "cdc_report": cdc_report,
         "dev": dev,
+        "nocache": nocache,
+        "history": history,
+        "incremental": incremental,
+        "profile": profile,
+        "profile_stats": profile_stats,
+        "workers": workers,
+        "reader": reader,
+        "towns": towns,
+        "watch": watch,
+        "in_memory": in_memory,
+        "noarchive": noarchive,
+        "discard_saved": discard_saved,
+        "serve": serve,
+        "only": only,
+        "clear_output": not args.only,
+        "backfill": backfill_range,
         "today": today,
         "fromdate": fromdate,
         "url": url,
     }
 
 
-def fetch_data(url, xlsx_path, is_dev):
-    """Fetch the data for today and extract the necessary files."""
-    if is_dev and len(os.listdir(TMP_DIR)) > 0:
-        # If we're in dev mode and the files exist, we don't have to fetch them again.
+def fetch_data(
+    url, xlsx_path, is_dev, session=None, buffer=None, archive=None, today=None
+):
+    """Fetch the data for today and extract the necessary files. If a buffer is passed
+    in, the workbook is downloaded into it, and nothing is written to xlsx_path.
+
+    If we already have today's workbook, in the tmp directory, the archive, or the
+    directory --backfill downloads to, the server is only asked to send it again if
+    it has changed. The copy we have is used if it hasn't, or if the server can't be
+    reached. If an archive is passed in, whatever is used is added to it."""
+    if is_dev and os.path.exists(xlsx_path):
+        # If we're in dev mode and the file exists, we don't have to fetch it again.
+        if buffer is not None:
+            with open(xlsx_path, "rb") as f:
+                buffer.write(f.read())
+            buffer.seek(0)
         return
 
-    r = requests.get(url, headers=REQUEST_HEADER)
-    if r.status_code == 200:
-        with open(xlsx_path, "wb+") as f:
-            f.write(r.content)
-        print("Downloaded today's data to {}".format(xlsx_path))
-    elif r.status_code == 404:
-        raise Exception(
-            "Data for this date was not found. This is probably because today's data "
-            "hasn't been published yet.",
-            url,
-        )
-    else:
+    import requests
+    from download import (
+        DownloadError,
+        TransientDownloadError,
+        download,
+        download_to_buffer,
+        read_meta,
+        write_meta,
+    )
+
+    data, meta, source = find_saved_copy(url, today, archive)
+    if buffer is None:
+        if os.path.exists(xlsx_path):
+            source = "downloaded"
+        elif data is not None:
+            # Put the copy where download will revalidate it
+            with open(xlsx_path, "wb") as f:
+                f.write(data)
+            write_meta(xlsx_path, meta)
+
+    try:
+        try:
+            if buffer is not None:
+                meta = dict(meta or {})
+                transferred = download_to_buffer(url, buffer, session, meta)
+            else:
+                transferred = download(url, xlsx_path, session)
+            profiler.add("bytes_downloaded", transferred)
+        except (requests.RequestException, TransientDownloadError):
+            if source is None:
+                raise
+            transferred = None
+            print(
+                "Couldn't reach the server, so using the {} copy of today's "
+                "data".format(source)
+            )
+    except DownloadError as e:
+        if e.status_code == 404:
+            raise Exception(
+                "Data for this date was not found. This is probably because today's "
+                "data hasn't been published yet.",
+                url,
+            )
         raise Exception(
             "Something went wrong when trying to download today's data",
-            r.status_code,
-            r.reason,
+            e.status_code,
+            e.reason,
         )
+    if buffer is not None:
+        if transferred:
+            print(
+                "Downloaded today's data ({:,} bytes) into memory".format(transferred)
+            )
+        else:
+            if transferred == 0:
+                print("Today's data is unchanged since the {} copy".format(source))
+            buffer.write(data)
+            buffer.seek(0)
+        if archive:
+            with buffer.getbuffer() as view:
+                archive.put(today, url, view, meta)
+    else:
+        if transferred:
+            print("Downloaded today's data to {}".format(xlsx_path))
+        elif transferred == 0:
+            print("Today's data at {} is already up to date".format(xlsx_path))
+        if archive:
+            with open(xlsx_path, "rb") as f:
+                archive.put(today, url, f.read(), read_meta(xlsx_path))
+
+
+def find_saved_copy(url, today, archive=None):
+    """Finds a copy of today's workbook that we've already downloaded, in the archive
+    or the directory --backfill downloads to. Returns its contents, the validators it
+    was downloaded with, and where it was found, or all None if there isn't one."""
+    if today is None:
+        return None, None, None
+    data = archive.get(today, url) if archive else None
+    if data is not None:
+        return data, archive.validators(today, url), "archived"
+    # --backfill downloads the published URL for each date, with its validators
+    url_date = today.strftime(URL_DATE_FMT).lower()
+    backfilled = os.path.join(BACKFILL_DIR, url_date + ".xlsx")
+    if url == URL.format(url_date) and os.path.exists(backfilled):
+        from download import read_meta
 
+        with open(backfilled, "rb") as f:
+            return f.read(), read_meta(backfilled), "backfilled"
+    return None, None, None
 
-def set_up_folders(is_dev):
+
+def set_up_folders(is_dev, xlsx_path, clear_output=True):
     """Ensure the tmp and output directories are in place and cleared as needed."""
     if not os.path.exists(TMP_DIR):
         # Create the tmp directory if it doesn't exist
         os.mkdir(TMP_DIR)
     elif not is_dev:
-        # Clear out the tmp directory if it does exist and we're not in dev mode
-        files = os.listdir(TMP_DIR)
+        # Clear out the tmp directory if it does exist and we're not in dev mode. The
+        # sheet cache is kept, since it's keyed by the contents of the workbook, as are
+        # the render state, since it checks every input it reuses, the last vaccination
+        # data, and today's download, since it's revalidated against the server before
+        # use.
+        keep = [SHEET_CACHE_FILE, RENDER_STATE_FILE, MANUAL_DATA_CACHE_FILE] + [
+            os.path.basename(xlsx_path) + ext
+            for ext in ["", ".meta", ".part", ".part.meta"]
+        ]
+        files = [f for f in os.listdir(TMP_DIR) if f not in keep]
         if len(files) != 0:
             [os.remove(os.path.join(TMP_DIR, f)) for f in files]
 
     if not os.path.exists(OUT_DIR):
         # Create the output directory if it doesn't exist
         os.mkdir(OUT_DIR)
-    else:
+    elif clear_output:
         # Clear out the output directory if it does exist
         files = os.listdir(OUT_DIR)
         if len(files) != 0:
@@ -144,6 +399,25 @@ def get_date_range(today, fromdate):
 
 def run():
     args = parse_args()
+    if args["backfill"]:
+        from download import backfill
+
+        backfill(*args["backfill"])
+        return
+
+    if args["watch"]:
+        watch(args)
+        return
+    if args["serve"]:
+        from server import serve
+
+        stores = open_stores(dict(args, history=False))
+        try:
+            serve(args, args["serve"], stores["cache"], stores["archive"])
+        finally:
+            close_stores(stores)
+        return
+
     today = args["today"]
     weekday = today.weekday()
     if weekday > 4:
@@ -154,21 +428,341 @@ def run():
             + today.strftime(DAY_FMT)
         )
 
+    stores = open_stores(args)
+    try:
+        if args["discard_saved"]:
+            discard_saved(args, today, stores["archive"])
+        generate(args, today, stores)
+    finally:
+        close_stores(stores)
+
+
+def open_stores(args):
+    """Opens the sheet cache, the history store and the download archive, unless
+    they're turned off."""
+    cache = None
+    if not args["nocache"]:
+        os.makedirs(TMP_DIR, exist_ok=True)
+        cache = SheetCache(
+            os.path.join(TMP_DIR, SHEET_CACHE_FILE), SHEET_CACHE_MAX_BYTES
+        )
+    history = None
+    if args["history"]:
+        from history import HistoryStore
+
+        history = HistoryStore(HISTORY_DIR)
+    archive = None
+    if not args["noarchive"]:
+        from archive import WorkbookArchive
+
+        archive = WorkbookArchive()
+    return {"cache": cache, "history": history, "archive": archive}
+
+
+def close_stores(stores):
+    for store in stores.values():
+        if store:
+            store.close()
+
+
+def get_url(args, today):
+    if args["url"]:
+        return args["url"]
+    return URL.format(today.strftime(URL_DATE_FMT).lower())
+
+
+def generate(args, today, stores, session=None):
+    """Downloads the data for today and generates the outputs from it, using the stores
+    from open_stores."""
+    cache = stores["cache"]
+    history = stores["history"]
     date_range = get_date_range(today, args["fromdate"])
     url_date = today.strftime(URL_DATE_FMT).lower()
     xlsx_path = os.path.join(TMP_DIR, url_date + ".xlsx")
+    url = get_url(args, today)
 
-    if args["url"]:
-        url = args["url"]
+    if args["profile"]:
+        profiler.start(args["profile_stats"])
+    with profiler.stage("set_up_folders"):
+        set_up_folders(args["dev"], xlsx_path, args["clear_output"])
+
+    state = None
+    if args["incremental"]:
+        state = RenderState(os.path.join(TMP_DIR, RENDER_STATE_FILE))
+    # In memory, the workbook is downloaded into a buffer that the reader reads from
+    # directly, rather than going through the tmp directory
+    buffer = io.BytesIO() if args["in_memory"] else None
+    source = xlsx_path if buffer is None else buffer
+    rows_read = {}
+    try:
+        with WorkbookSession(source, cache=cache, reader=args["reader"]) as workbook:
+            results = schedule_stages(
+                args,
+                workbook,
+                url,
+                xlsx_path,
+                today,
+                date_range,
+                history,
+                state,
+                session,
+                buffer,
+                stores["archive"],
+            ).run()
+            rows_read = workbook.rows_read()
+        if history:
+            print("Updated {} days in the history store".format(results["history"]))
+        if state:
+            state.save()
+            print("Rendered {} new or changed chart values".format(state.rendered))
+    finally:
+        if profiler.enabled:
+            write_profile(rows_read)
+
+
+def watch(args):
+    """Waits for each weekday's data to be published, and generates the outputs as soon
+    as it is. The URL is checked without downloading it, more and more slowly while it
+    isn't there yet. The HTTP session, the stores and the imported generators and
+    lookup tables are kept between days. The date is always today's, so -date and -url
+    are ignored, and the vaccination data is never prompted for; the last values are
+    reused unless it's given with --vax, --manual-file or --cdc-report. A day that
+    fails is logged and tried again after backing off."""
+    import requests
+    from download import DownloadError, is_published, make_session
+
+    args = dict(args, url=None, nomanual=True)
+    if "infobox" in args["only"]:
+        from manual_data import load_manual_data
+
+        # Fail now rather than once the first day's data is out if the vaccination
+        # data can't be read
+        os.makedirs(TMP_DIR, exist_ok=True)
+        load_manual_data(args)
+    session = make_session()
+    stores = open_stores(args)
+    done = None
+    polling = None
+    interval = WATCH_INTERVAL
+    try:
+        while True:
+            today = date.today()
+            if today == done or today.weekday() > 4:
+                time.sleep(WATCH_IDLE_INTERVAL)
+                continue
+            if today != polling:
+                # Don't carry the backoff over from a day that was never published
+                polling = today
+                interval = WATCH_INTERVAL
+            try:
+                published = is_published(get_url(args, today), session)
+            except (DownloadError, requests.RequestException) as e:
+                print("Couldn't check for today's data: {}".format(e))
+                published = False
+            if not published:
+                time.sleep(interval)
+                interval = min(interval * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+                continue
+
+            print("Data for {} is out".format(today.strftime(DAY_FMT)))
+            try:
+                generate(args, today, stores, session)
+            except Exception:
+                # It may have been caught half-published, or the download may have
+                # failed, so throw away whatever was downloaded and try the day again
+                print("Couldn't generate the output for today:")
+                traceback.print_exc()
+                discard_download(args, today, stores["archive"])
+                time.sleep(interval)
+                interval = min(interval * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+                continue
+            done = today
+            interval = WATCH_INTERVAL
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        session.close()
+        close_stores(stores)
+
+
+def discard_download(args, today, archive=None):
+    """Deletes the workbook downloaded for today, from the tmp directory, the archive
+    and the backfill directory, so that it's downloaded again next time."""
+    url_date = today.strftime(URL_DATE_FMT).lower()
+    for directory in [TMP_DIR, BACKFILL_DIR]:
+        xlsx_path = os.path.join(directory, url_date + ".xlsx")
+        for path in [xlsx_path, xlsx_path + ".meta"]:
+            if os.path.exists(path):
+                os.remove(path)
+    if archive:
+        archive.discard(today, get_url(args, today))
+
+
+def discard_saved(args, today, archive=None):
+    """Handles --discard-saved. The archive is cleared out even if it isn't otherwise
+    in use for this run."""
+    if archive is None and os.path.exists(ARCHIVE_DIR):
+        from archive import WorkbookArchive
+
+        with closing(WorkbookArchive()) as archive:
+            discard_download(args, today, archive)
     else:
-        url = URL.format(url_date)
+        discard_download(args, today, archive)
+    print("Threw away the saved copies of the data for " + today.strftime(DAY_FMT))
+
+
+def schedule_stages(
+    args,
+    workbook,
+    url,
+    xlsx_path,
+    today,
+    date_range,
+    history,
+    state,
+    session=None,
+    buffer=None,
+    archive=None,
+):
+    """Sets up the stages of a run, each to start as soon as the ones it needs are done:
+    the download, then reading the sheets, then the history store if it's in use, then
+    the generators. Once the download is done, the vaccination data is asked for on
+    the main thread while the rest goes on, and the infobox waits for it."""
+    scheduler = Scheduler()
+
+    def stage(name, fn, *params):
+        def run():
+            with profiler.stage(name):
+                return fn(*params)
+
+        return run
+
+    scheduler.add(
+        "download",
+        stage(
+            "download",
+            fetch_data,
+            url,
+            xlsx_path,
+            args["dev"],
+            session,
+            buffer,
+            archive,
+            today,
+        ),
+    )
+
+    # The history store is filled from every sheet, whichever stages are run
+    sheetnames = RAW_DATA_SHEETS
+    if not history:
+        sheetnames = [
+            sheetname
+            for sheetname in RAW_DATA_SHEETS
+            if any(sheetname in STAGE_SHEETS[only] for only in args["only"])
+        ]
+    scheduler.add(
+        "load_workbook",
+        stage(
+            "load_workbook",
+            load_sheets,
+            workbook,
+            sheetnames,
+            args["workers"],
+            bool(history) or args["profile"],
+        ),
+        after=["download"],
+    )
+    loaded = "load_workbook"
+    if history:
+        from history import update_history
+
+        scheduler.add(
+            "history",
+            stage("history", update_history, history, workbook, today),
+            after=[loaded],
+        )
+        loaded = "history"
 
-    set_up_folders(args["dev"])
-    fetch_data(url, xlsx_path, args["dev"])
+    if "infobox" in args["only"]:
+        from infobox_and_barchart import create_infobox_and_barchart
+        from manual_data import load_manual_data
 
-    create_infobox_and_barchart(xlsx_path, url, today, date_range, args)
-    create_daily_county_table(xlsx_path, today)
-    create_statistics_graphs(xlsx_path, today)
+        scheduler.add(
+            "manual_input",
+            stage("manual_input", load_manual_data, args),
+            after=["download"],
+            main_thread=True,
+        )
+
+        def infobox():
+            with profiler.stage("infobox_and_barchart"):
+                create_infobox_and_barchart(
+                    workbook,
+                    url,
+                    today,
+                    date_range,
+                    args,
+                    history,
+                    state,
+                    scheduler.results["manual_input"],
+                )
+
+        scheduler.add("infobox", infobox, after=[loaded, "manual_input"])
+    if "county" in args["only"]:
+        from cases_by_county_daily_table import create_daily_county_table
+
+        scheduler.add(
+            "county",
+            stage("daily_county_table", create_daily_county_table, workbook, today),
+            after=[loaded],
+        )
+    if "statistics" in args["only"]:
+        from statistics import create_statistics_graphs
+
+        scheduler.add(
+            "statistics",
+            stage(
+                "statistics", create_statistics_graphs, workbook, today, history, state
+            ),
+            after=[loaded],
+        )
+    if args["towns"]:
+        from town_rollup import create_town_rollup
+
+        scheduler.add(
+            "towns",
+            stage("town_rollup", create_town_rollup, workbook),
+            after=[loaded],
+        )
+    return scheduler
+
+
+def load_sheets(workbook, sheetnames, workers, full=False):
+    """Reads the given sheets ahead of the generators, in worker processes if there's
+    more than one. They're only read in full if they'd be read in full anyway: for the
+    sheet cache, the history store or the profiler (which times each sheet on its
+    own). Otherwise the generators read them lazily, only as far as they need."""
+    if workers > 1:
+        workbook.preload(sheetnames, workers)
+    elif full or workbook.cache:
+        for sheetname in sheetnames:
+            with profiler.stage(sheetname):
+                workbook.get_sheet(sheetname).read_through()
+
+
+def write_profile(rows_read):
+    """Writes the profiling report, and the cProfile statistics of the profiled stage if
+    they were collected, to the output directory."""
+    profiler.add(
+        "bytes_written",
+        sum(os.path.getsize(os.path.join(OUT_DIR, f)) for f in os.listdir(OUT_DIR)),
+    )
+    profiler.stop()
+    report_path = os.path.join(OUT_DIR, PROFILE_REPORT_FILE)
+    profiler.write_report(report_path, rows_read=rows_read)
+    if profiler.cprofile:
+        profiler.dump_stats(os.path.join(OUT_DIR, PROFILE_STATS_FILE))
+    print("Wrote the profiling report to {}".format(report_path))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Sources for the vaccination data that isn't in the MDPH workbook, so that a run
+doesn't have to stop and ask for it. Each source gives the same strings that would be
+typed in at the prompts: a count and a percentage for each of one dose and fully
+vaccinated, like "4,800,123 (69.1%)", and the date they're as of."""
+
+import json
+import os
+import re
+from datetime import date, datetime
+
+from constants import *
+from infobox_and_barchart import get_manual_data, parse_vax
+
+MANUAL_FIELDS = ["one_dose", "fully_vaccinated", "as_of"]
+
+# How the CDC's state profile report labels each figure, when it's saved as text or
+# HTML
+CDC_REPORT_PATTERNS = {
+    "one_dose": re.compile(
+        r"at\s+least\s+one\s+dose\D{0,200}?([\d,]{4,})\D{0,200}?([\d.]+%)", re.I | re.S
+    ),
+    "fully_vaccinated": re.compile(
+        r"fully\s+vaccinated\D{0,200}?([\d,]{4,})\D{0,200}?([\d.]+%)", re.I | re.S
+    ),
+    "as_of": re.compile(
+        r"as\s+of\s*:?\s*(\d{4}-\d{2}-\d{2}|[A-Z][a-z]+ \d{1,2}, \d{4})", re.I
+    ),
+}
+
+
+class Placeholder:
+    """Stands in for a vaccination figure we don't have. It's written out as
+    MANUAL_DATA_PLACEHOLDER wherever the figure would go, to be filled in by hand."""
+
+    def __format__(self, spec):
+        return MANUAL_DATA_PLACEHOLDER
+
+    def strftime(self, fmt):
+        return MANUAL_DATA_PLACEHOLDER
+
+
+def placeholders():
+    return {
+        "one_dose_num": Placeholder(),
+        "one_dose_perc": Placeholder(),
+        "fully_vaccinated_num": Placeholder(),
+        "fully_vaccinated_perc": Placeholder(),
+        "as_of": Placeholder(),
+    }
+
+
+def from_fields(fields):
+    """Makes the manual data from the three strings."""
+    one_dose = parse_vax(fields["one_dose"])
+    fully_vaccinated = parse_vax(fields["fully_vaccinated"])
+    if not one_dose or not fully_vaccinated:
+        raise Exception("Couldn't read the vaccination numbers", fields)
+    return {
+        "one_dose_num": one_dose[0],
+        "one_dose_perc": one_dose[1],
+        "fully_vaccinated_num": fully_vaccinated[0],
+        "fully_vaccinated_perc": fully_vaccinated[1],
+        "as_of": date.fromisoformat(fields["as_of"]),
+    }
+
+
+def to_fields(manual_data):
+    return {
+        "one_dose": "{:,} ({})".format(
+            manual_data["one_dose_num"], manual_data["one_dose_perc"]
+        ),
+        "fully_vaccinated": "{:,} ({})".format(
+            manual_data["fully_vaccinated_num"], manual_data["fully_vaccinated_perc"]
+        ),
+        "as_of": manual_data["as_of"].isoformat(),
+    }
+
+
+def read_manual_file(path):
+    """Reads the fields from a JSON file, or a YAML file if PyYAML is installed."""
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception(
+                    "Reading a YAML file needs PyYAML to be installed", path
+                )
+            fields = yaml.safe_load(f)
+        else:
+            fields = json.load(f)
+    missing = [field for field in MANUAL_FIELDS if not fields.get(field)]
+    if missing:
+        raise Exception("The manual data file is missing some fields", path, missing)
+    # YAML reads an unquoted date as a date
+    return {field: str(fields[field]) for field in MANUAL_FIELDS}
+
+
+def parse_report_date(text):
+    """Parses a date written out like "September 8, 2021" or "Sep 8, 2021"."""
+    for fmt in ["%B %d, %Y", "%b %d, %Y"]:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    raise Exception("Couldn't read the date in the CDC report", text)
+
+
+def read_cdc_report(path):
+    """Reads the fields from a copy of the CDC's state profile report that's been saved
+    as text or HTML."""
+    with open(path, errors="replace") as f:
+        text = re.sub(r"<[^>]*>", " ", f.read())
+    fields = {}
+    for field, pattern in CDC_REPORT_PATTERNS.items():
+        result = pattern.search(text)
+        if not result:
+            raise Exception("Couldn't find this in the CDC report", path, field)
+        if field == "as_of":
+            as_of = result.group(1)
+            if not as_of[0].isdigit():
+                as_of = parse_report_date(as_of).isoformat()
+            fields[field] = as_of
+        else:
+            fields[field] = "{} ({})".format(result.group(1), result.group(2))
+    return fields
+
+
+def read_cached():
+    """The fields used on the last run, if there was one."""
+    try:
+        with open(os.path.join(TMP_DIR, MANUAL_DATA_CACHE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cached(fields):
+    with open(os.path.join(TMP_DIR, MANUAL_DATA_CACHE_FILE), "w") as f:
+        json.dump(fields, f, indent=2)
+        f.write("\n")
+
+
+def load_manual_data(args):
+    """Gets the vaccination data from the first source that has it: the three values
+    given with --vax, a --manual-file, a saved --cdc-report, or the prompts. With
+    --no-manual there are no prompts, and the values from the last run are used if
+    nothing else is given, since the CDC doesn't publish new numbers every day, or
+    placeholders if there was no last run. Whatever is used, other than placeholders,
+    is cached for next time."""
+    if args["vax"]:
+        fields = dict(zip(MANUAL_FIELDS, args["vax"]))
+    elif args["manual_file"]:
+        fields = read_manual_file(args["manual_file"])
+    elif args["cdc_report"]:
+        fields = read_cdc_report(args["cdc_report"])
+    elif not args["nomanual"]:
+        manual_data = get_manual_data()
+        write_cached(to_fields(manual_data))
+        return manual_data
+    else:
+        fields = read_cached()
+        if fields is None:
+            print(
+                "There's no vaccination data from an earlier run to reuse, so "
+                "placeholders are written in its place"
+            )
+            return placeholders()
+        print("Reusing the vaccination data as of {}".format(fields["as_of"]))
+    manual_data = from_fields(fields)
+    write_cached(fields)
+    return manual_data
@@ -0,0 +1,160 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import cProfile
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Records the wall time, CPU time (of the thread it ran on) and peak traced memory
+    of each stage of a run, along with any counters the stages add. Stages can be
+    nested, and are reported by their path, e.g. "infobox_and_barchart/manual_input".
+    Until start() is called, stages are run without any of this, so the generators can
+    mark their stages unconditionally.
+
+    Stages can run at the same time on different threads, each nesting separately.
+    Memory is traced for the whole process, though, so the peaks of stages that overlap
+    cover each other's allocations.
+
+    The report names the slowest top-level stage. If cprofile is set, top-level stages
+    are also run under cProfile, and the statistics for the slowest profiled one are
+    kept. Only one profile can be collected at a time, though, so a stage that starts
+    while another is being profiled isn't, and the profiled stage the statistics are
+    for isn't necessarily the slowest stage."""
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile = False
+        self.stages = []
+        self.counters = {}
+        self.profiled = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiling = False
+        self._slowest_stats = None
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, cprofile=False):
+        """Starts recording, dropping anything recorded before."""
+        self.stages = []
+        self.counters = {}
+        self.profiled = None
+        self._slowest_stats = None
+        self.enabled = True
+        self.cprofile = cprofile
+        tracemalloc.start()
+
+    def stop(self):
+        if self.enabled:
+            tracemalloc.stop()
+            self.enabled = False
+
+    def add(self, name, value):
+        """Adds to a counter."""
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        path = "/".join([frame["stage"] for frame in self._stack] + [name])
+        record = {"stage": path}
+        self.stages.append(record)
+        if self._stack:
+            # The peak is reset for each stage, so hold on to the enclosing stage's
+            # peak so far
+            parent = self._stack[-1]
+            parent["peak"] = max(parent["peak"], tracemalloc.get_traced_memory()[1])
+        frame = {"stage": name, "peak": 0}
+        self._stack.append(frame)
+        profile = None
+        if self.cprofile and len(self._stack) == 1:
+            with self._lock:
+                if not self._profiling:
+                    self._profiling = True
+                    profile = cProfile.Profile()
+
+        tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            record["wall_seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.thread_time() - cpu
+            record["peak_bytes"] = max(
+                frame["peak"], tracemalloc.get_traced_memory()[1]
+            )
+            self._stack.pop()
+            if self._stack:
+                parent = self._stack[-1]
+                parent["peak"] = max(parent["peak"], record["peak_bytes"])
+            if profile:
+                with self._lock:
+                    self._profiling = False
+                    if (
+                        self.profiled is None
+                        or record["wall_seconds"] > self._slowest_stats[0]
+                    ):
+                        self.profiled = path
+                        self._slowest_stats = (record["wall_seconds"], profile)
+
+    def write_report(self, path, **extra):
+        """Writes the stages and counters, along with anything else passed in, to a JSON
+        file."""
+        report = {"stages": self.stages, "counters": self.counters}
+        report.update(extra)
+        top_level = [s for s in self.stages if "/" not in s["stage"]]
+        if top_level:
+            slowest = max(top_level, key=lambda s: s.get("wall_seconds", 0))
+            report["slowest_stage"] = slowest["stage"]
+        if self.profiled:
+            report["profiled_stage"] = self.profiled
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    def dump_stats(self, path):
+        """Writes the cProfile statistics of the slowest profiled stage (profiled_stage
+        in the report), if they were collected. These can be read with pstats."""
+        if self._slowest_stats:
+            self._slowest_stats[1].dump_stats(path)
+
+
+# The profiler for this run. It's disabled unless main.py is run with --profile.
+profiler = Profiler()
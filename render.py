@@ -0,0 +1,146 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import io
+import os
+import pickle
+import threading
+from array import array
+from contextlib import contextmanager
+from string import Formatter
+
+from constants import *
+
+_capture = threading.local()
+
+
+def open_output(filename, mode="w+"):
+    """Opens a file in the output directory with a write buffer big enough that each
+    output goes to disk in a handful of writes, however many pieces it's written in.
+    Inside capture_outputs, the output is kept in memory instead."""
+    outputs = getattr(_capture, "outputs", None)
+    if outputs is not None:
+        return CapturedOutput(outputs, filename, mode)
+    return open(os.path.join(OUT_DIR, filename), mode, buffering=OUTPUT_BUFFER_SIZE)
+
+
+@contextmanager
+def capture_outputs():
+    """Collects everything this thread writes through open_output into a dict of
+    filename -> text, rather than writing it to the output directory."""
+    outputs = {}
+    _capture.outputs = outputs
+    try:
+        yield outputs
+    finally:
+        _capture.outputs = None
+
+
+class CapturedOutput(io.StringIO):
+    """An output file kept in memory, which is saved to the capturing dict when it's
+    closed."""
+
+    def __init__(self, outputs, filename, mode):
+        super().__init__()
+        self._outputs = outputs
+        self._filename = filename
+        if "a" in mode:
+            self.write(outputs.get(filename, ""))
+
+    def close(self):
+        if not self.closed:
+            self._outputs[self._filename] = self.getvalue()
+        super().close()
+
+
+def name_fields(template, *names):
+    """Gives the automatically numbered fields of a format string the given names, in
+    order, so that it can be embedded into a larger template and filled in with a
+    single format call."""
+    names = iter(names)
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is not None:
+            parts.append("{" + (field or next(names)))
+            if conversion:
+                parts.append("!" + conversion)
+            if spec:
+                parts.append(":" + spec)
+            parts.append("}")
+    return "".join(parts)
+
+
+class RenderState:
+    """The pieces each chart was rendered from on the last run, along with the
+    inputs they were rendered from. Rendering a chart through this keeps the leading
+    pieces whose inputs haven't changed as they are, and only renders the rest, so that
+    a daily run only formats the days that are new."""
+
+    def __init__(self, path):
+        self.path = path
+        self.rendered = 0
+        self._lock = threading.Lock()
+        try:
+            with open(path, "rb") as f:
+                self._charts = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self._charts = {}
+
+    def join(self, name, inputs, render, sep):
+        """Renders each of the inputs with the render function and joins them with the
+        separator, reusing as much of the last run's text for this chart as is still
+        current."""
+        with self._lock:
+            return self._join(name, inputs, render, sep)
+
+    def _join(self, name, inputs, render, sep):
+        inputs = list(inputs)
+        keep = 0
+        text = ""
+        ends = array("q")
+        previous = self._charts.get(name)
+        if previous and previous[3] == sep:
+            old_inputs, old_text, old_ends, _ = previous
+            keep = min(len(old_inputs), len(inputs))
+            # The common case is that nothing already rendered has changed, which a
+            # single slice comparison confirms
+            if old_inputs[:keep] != inputs[:keep]:
+                keep = next(i for i in range(keep) if old_inputs[i] != inputs[i])
+            if keep:
+                text = old_text[: old_ends[keep - 1]]
+                ends = old_ends[:keep]
+
+        pieces = [text] if keep else []
+        end = len(text)
+        for item in inputs[keep:]:
+            piece = render(item)
+            end += len(piece) + (len(sep) if pieces else 0)
+            pieces.append(piece)
+            ends.append(end)
+        self.rendered += len(inputs) - keep
+        text = sep.join(pieces)
+        self._charts[name] = (inputs, text, ends, sep)
+        return text
+
+    def save(self):
+        with open(self.path, "wb") as f:
+            pickle.dump(self._charts, f, pickle.HIGHEST_PROTOCOL)
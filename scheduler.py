@@ -0,0 +1,114 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Scheduler:
+    """Runs a set of tasks, each one as soon as the tasks it comes after have finished.
+    Tasks run on a small pool of threads, apart from those marked to run on the calling
+    thread (the ones that prompt the operator), which run there as soon as they're
+    ready. New tasks are handed to the pool as the ones they wait on finish, so the
+    pool keeps working while the calling thread waits on a prompt.
+
+    If a task fails, the tasks that haven't started are dropped, and the exception is
+    raised once the ones that are running have finished."""
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.tasks = {}
+        self.results = {}
+
+    def add(self, name, fn, after=(), main_thread=False):
+        """Adds a task. Its function is called with no arguments; the results of
+        earlier tasks are in the scheduler's results by name."""
+        self.tasks[name] = (fn, [a for a in after if a], main_thread)
+
+    def run(self):
+        self._pending = dict(self.tasks)
+        self._active = 0
+        self._error = None
+        # Finished pool tasks dispatch their dependents from the pool's threads, and
+        # a callback can run straight away on the thread that adds it
+        self._lock = threading.RLock()
+        # Tasks for the calling thread, then None once nothing is left to run
+        self._main = queue.Queue()
+        with ThreadPoolExecutor(max_workers=self.workers) as self._pool:
+            with self._lock:
+                self._dispatch()
+            while True:
+                name = self._main.get()
+                if name is None:
+                    break
+                try:
+                    result = self.tasks[name][0]()
+                except BaseException as e:
+                    self._finish(name, error=e)
+                else:
+                    self._finish(name, result)
+        if self._error is not None:
+            raise self._error
+        return self.results
+
+    def _dispatch(self):
+        if self._error is None:
+            ready = [
+                name
+                for name, (_, after, _) in self._pending.items()
+                if all(a in self.results for a in after)
+            ]
+            # Take every ready task off pending before starting any, since a callback
+            # for a pool task that finishes straight away dispatches again from here
+            started = [(name, self._pending.pop(name)) for name in ready]
+            self._active += len(started)
+            for name, (fn, _, main_thread) in started:
+                if main_thread:
+                    self._main.put(name)
+                else:
+                    future = self._pool.submit(fn)
+                    future.add_done_callback(
+                        lambda future, name=name: self._pool_done(name, future)
+                    )
+        if self._active == 0:
+            if self._error is None and self._pending:
+                self._error = Exception(
+                    "These tasks are waiting on tasks that don't exist",
+                    list(self._pending),
+                )
+            self._main.put(None)
+
+    def _pool_done(self, name, future):
+        error = future.exception()
+        if error is None:
+            self._finish(name, future.result())
+        else:
+            self._finish(name, error=error)
+
+    def _finish(self, name, result=None, error=None):
+        with self._lock:
+            self._active -= 1
+            if error is None:
+                self.results[name] = result
+            elif self._error is None:
+                self._error = error
+            self._dispatch()
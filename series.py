@@ -0,0 +1,90 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from array import array
+from datetime import date
+
+
+class DailySeries:
+    """A value for each day from start onward, kept in a flat array indexed by the day's
+    ordinal less start's. Days without data hold the fill value; a fill of None keeps
+    the values in a list instead, so that missing days can be told apart."""
+
+    __slots__ = ("start", "values")
+
+    def __init__(self, start, length, fill=0, typecode="q"):
+        self.start = start.toordinal()
+        if fill is None:
+            self.values = [None] * length
+        else:
+            self.values = array(typecode, [fill]) * length
+
+    def __len__(self):
+        return len(self.values)
+
+    def index(self, d):
+        return d.toordinal() - self.start
+
+    def covers(self, d):
+        return 0 <= self.index(d) < len(self.values)
+
+    def __getitem__(self, d):
+        return self.values[self.index(d)]
+
+    def __setitem__(self, d, value):
+        self.values[self.index(d)] = value
+
+    def join(self, sep=", "):
+        """Formats every value into a single separated string."""
+        return sep.join(map(str, self.values))
+
+
+class DailyFrame:
+    """Named DailySeries that all cover the same run of days. This is the shape the
+    generators pass their data around in, in place of dicts of per-day dicts keyed by
+    formatted date strings."""
+
+    __slots__ = ("start", "length", "columns")
+
+    def __init__(self, start, length):
+        self.start = start
+        self.length = length
+        self.columns = {}
+
+    @classmethod
+    def over(cls, dates):
+        """Makes a frame running from the first to the last of a sorted list of dates."""
+        return cls(dates[0], (dates[-1] - dates[0]).days + 1)
+
+    @property
+    def dates(self):
+        first = self.start.toordinal()
+        return [date.fromordinal(first + i) for i in range(self.length)]
+
+    def add(self, name, fill=None, typecode="q"):
+        self.columns[name] = DailySeries(self.start, self.length, fill, typecode)
+        return self.columns[name]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
@@ -0,0 +1,301 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Serves the outputs for any report date over HTTP, so that they can be read without
+racing a run that's rewriting the output directory:
+
+    /YYYY-MM-DD/infobox_and_barchart.txt
+    /YYYY-MM-DD/daily_county.txt
+    /YYYY-MM-DD/statistics.txt
+    /YYYY-MM-DD/series.json                 every series in the workbook
+    /YYYY-MM-DD/series/<metric>.json        one series, or .txt for tab-separated
+
+The workbook for a date is looked for in the tmp and backfill directories and then the
+archive, and downloaded into memory (and the archive) if it isn't in any of them.
+Responses are kept in an LRU cache keyed by date and output, and carry an ETag, so a
+repeated request is never computed twice and can be answered with a 304."""
+
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from constants import *
+from excel import WorkbookSession, get_excel_data_between
+from history import HISTORY_METRICS, HISTORY_START, sum_columns
+from render import capture_outputs
+from cases_by_county_daily_table import create_daily_county_table, get_county_matrix
+from infobox_and_barchart import create_infobox_and_barchart
+from manual_data import load_manual_data
+from statistics import create_statistics_graphs
+
+# The outputs that can be served for each date
+OUTPUT_FILES = ["infobox_and_barchart.txt", "daily_county.txt", "statistics.txt"]
+SERIES_FORMATS = ["json", "txt"]
+
+
+class NotFound(Exception):
+    pass
+
+
+class ResponseCache:
+    """The most recently used responses, up to size, as (body, content type, ETag).
+    Each key has its own lock while its response is computed, so that two requests for
+    the same thing don't both compute it, but requests for anything else aren't held
+    up behind it."""
+
+    def __init__(self, size):
+        self.size = size
+        self._responses = OrderedDict()
+        self._computing = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                return self._responses[key]
+            return None
+
+    def get(self, key, compute):
+        response = self._lookup(key)
+        if response is not None:
+            return response
+        with self._lock:
+            key_lock = self._computing.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another request may have computed it while we waited
+            response = self._lookup(key)
+            if response is not None:
+                return response
+            try:
+                body, content_type = compute()
+                response = (
+                    body,
+                    content_type,
+                    '"{}"'.format(hashlib.sha256(body).hexdigest()[:32]),
+                )
+                with self._lock:
+                    self._responses[key] = response
+                    if len(self._responses) > self.size:
+                        self._responses.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._computing.pop(key, None)
+            return response
+
+
+def find_workbook(today, session, archive=None):
+    """Finds the workbook for a report date, downloading it if we don't have it. Returns
+    its path, or a buffer holding it."""
+    from download import DownloadError, download_to_buffer
+
+    url_date = today.strftime(URL_DATE_FMT).lower()
+    for directory in [TMP_DIR, BACKFILL_DIR]:
+        path = os.path.join(directory, url_date + ".xlsx")
+        if os.path.exists(path):
+            return path
+    url = URL.format(url_date)
+    data = archive.get(today, url) if archive else None
+    if data is not None:
+        return io.BytesIO(data)
+
+    buffer = io.BytesIO()
+    meta = {}
+    try:
+        download_to_buffer(url, buffer, session, meta)
+    except DownloadError as e:
+        if e.status_code == 404:
+            raise NotFound("There's no data for this date", today.isoformat())
+        raise
+    if archive:
+        with buffer.getbuffer() as view:
+            archive.put(today, url, view, meta)
+    return buffer
+
+
+def get_series(workbook, today):
+    """Gets every series we'd keep in the history store, as metric -> {date: value}."""
+    series = {}
+    for sheetname, metrics in HISTORY_METRICS.items():
+        rows = get_excel_data_between(workbook, HISTORY_START, today, sheetname)
+        for metric, headings in metrics.items():
+            series[metric] = {
+                d.isoformat(): sum_columns(row, headings) for d, row in rows.items()
+            }
+    counties = get_county_matrix(workbook, HISTORY_START, today)
+    dates = [d.isoformat() for d in counties.dates]
+    for (metric, county), values in counties.columns.items():
+        series["county_{}.{}".format(metric, county)] = dict(zip(dates, values.values))
+    return series
+
+
+class Outputs:
+    """Works out each output for a report date. Each one opens the date's workbook
+    afresh, but with the sheet cache, sheets already parsed for another output are
+    read back from there."""
+
+    def __init__(self, args, cache=None, session=None, archive=None):
+        self.args = dict(args, nomanual=True)
+        self.cache = cache
+        self.session = session
+        self.archive = archive
+
+    def render(self, today, filename):
+        if filename not in OUTPUT_FILES:
+            raise NotFound("There's no output with this name", filename)
+        path = find_workbook(today, self.session, self.archive)
+        with WorkbookSession(path, cache=self.cache, reader=self.args["reader"]) as wb:
+            with capture_outputs() as outputs:
+                if filename == "infobox_and_barchart.txt":
+                    fromdate = self.args["fromdate"]
+                    if not fromdate or fromdate > today:
+                        fromdate = today
+                    date_range = [
+                        fromdate + timedelta(days=i)
+                        for i in range((today - fromdate).days + 1)
+                    ]
+                    create_infobox_and_barchart(
+                        wb,
+                        URL.format(today.strftime(URL_DATE_FMT).lower()),
+                        today,
+                        date_range,
+                        self.args,
+                        manual_data=load_manual_data(self.args),
+                    )
+                elif filename == "daily_county.txt":
+                    create_daily_county_table(wb, today)
+                else:
+                    create_statistics_graphs(wb, today)
+        return outputs[filename].encode(), "text/plain; charset=utf-8"
+
+    def series(self, today):
+        path = find_workbook(today, self.session, self.archive)
+        with WorkbookSession(path, cache=self.cache, reader=self.args["reader"]) as wb:
+            return get_series(wb, today)
+
+
+def make_handler(outputs, responses):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send(head=False)
+
+        def do_HEAD(self):
+            self.send(head=True)
+
+        def send(self, head):
+            try:
+                body, content_type, etag = self.respond()
+            except NotFound as e:
+                self.send_error(404, " ".join(str(a) for a in e.args))
+                return
+            except Exception as e:
+                self.send_error(500, " ".join(str(a) for a in e.args))
+                return
+            if etag_matches(self.headers.get("If-None-Match"), etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+
+        def respond(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            try:
+                today = date.fromisoformat(parts[0])
+            except ValueError:
+                raise NotFound("Paths start with a date, like /2021-09-10/", self.path)
+            # Check the path before doing anything that might need a download
+            if len(parts) == 2 and parts[1] in OUTPUT_FILES:
+                return responses.get(
+                    (today, parts[1]), lambda: outputs.render(today, parts[1])
+                )
+            if parts[1:] == ["series.json"]:
+                return self.all_series(today)
+            if len(parts) != 3 or parts[1] != "series":
+                raise NotFound("There's nothing at this path", self.path)
+            metric, _, ext = parts[2].rpartition(".")
+            if ext not in SERIES_FORMATS:
+                raise NotFound("Series can be .json or .txt", ext)
+            series = self.all_series(today)
+            return responses.get(
+                (today, parts[2]), lambda: format_series(series[0], metric, ext)
+            )
+
+        def all_series(self, today):
+            return responses.get(
+                (today, "series.json"),
+                lambda: (
+                    json.dumps(outputs.series(today)).encode(),
+                    "application/json",
+                ),
+            )
+
+    return Handler
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header matches an ETag. The header can list several
+    ETags, or be *, and they're compared weakly, as RFC 9110 asks for."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    if "*" in tags:
+        return True
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+
+def format_series(all_series, metric, ext):
+    values = json.loads(all_series).get(metric)
+    if values is None:
+        raise NotFound("There's no series with this name", metric)
+    if ext == "json":
+        return json.dumps(values).encode(), "application/json"
+    lines = ["{}\t{}".format(d, v) for d, v in values.items()]
+    return "\n".join(lines).encode(), "text/plain; charset=utf-8"
+
+
+def serve(args, port, cache=None, archive=None):
+    """Serves the outputs on localhost until interrupted."""
+    from download import make_session
+
+    session = make_session()
+    outputs = Outputs(args, cache, session, archive)
+    responses = ResponseCache(SERVER_CACHE_SIZE)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(outputs, responses))
+    print("Serving outputs at http://127.0.0.1:{}/".format(server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped serving")
+    finally:
+        server.server_close()
+        session.close()
@@ -18,10 +18,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os
 from constants import *
 from datetime import date, timedelta
-from excel import get_excel_data_for_date_range, safe_lookup
+from render import open_output
+from series import DailyFrame
 
 
 def create_date_list(today):
@@ -48,68 +48,102 @@ def safe_sum(v1, v2):
     return 0
 
 
-def create_cases_charts(xlsx_path, date_list):
-    cases_date_list = date_list[:-1]
-    date_str_list = [d.strftime(DAY_FMT) for d in cases_date_list]
-    data = {d: {} for d in date_str_list}
+def fill_series(series, dates, workbook, history, sheetname, heading, metric):
+    """Fills a series from one column of a sheet, or from the matching metric in the
+    history store. Days with no value keep the series' fill value."""
+    if history:
+        for ind, val in enumerate(history.series(metric, dates)):
+            if val is not None:
+                series.values[ind] = int(val)
+    else:
+        sheet = workbook.get_sheet(sheetname)
+        col = sheet.headings.index(heading)
+        for row in sheet.rows_between(dates[0], dates[-1]):
+            if row[col] is not None:
+                series[row[0].date()] = int(row[col])
+
+
+def join_dates(dates, name, state=None):
+    if state:
+        return state.join(name, dates, lambda d: d.strftime(STATISTICS_DAY_FMT), ", ")
+    return ", ".join([d.strftime(STATISTICS_DAY_FMT) for d in dates])
+
 
-    case_data = get_excel_data_for_date_range(
-        xlsx_path, date_list, "CasesByDate (Test Date)"
+def join_series(series, name, state=None):
+    if state:
+        return state.join(name, series.values, str, ", ")
+    return series.join()
+
+
+def create_cases_charts(workbook, date_list, history=None, state=None):
+    cases_date_list = date_list[:-1]
+    sheetname = "CasesByDate (Test Date)"
+    data = DailyFrame.over(cases_date_list)
+    fill_series(
+        data.add("total", -1),
+        cases_date_list,
+        workbook,
+        history,
+        sheetname,
+        "Positive Total",
+        "cases_by_test_date",
+    )
+    fill_series(
+        data.add("new", -1),
+        cases_date_list,
+        workbook,
+        history,
+        sheetname,
+        "Positive New",
+        "new_cases_by_test_date",
     )
-    for d in date_list:
-        data[d.strftime(DAY_FMT)] = {
-            "total": safe_lookup(
-                case_data[d] if d in case_data else None, "Positive Total", -1
-            ),
-            "new": safe_lookup(
-                case_data[d] if d in case_data else None, "Positive New", -1
-            ),
-        }
-
-    out_str = "CASES DATES:\n"
-    out_str += ", ".join([d.strftime(STATISTICS_DAY_FMT) for d in cases_date_list])
-    out_str += "\n\nTOTAL CASES:\n"
-    out_str += ", ".join([str(data[date_str]["total"]) for date_str in date_str_list])
-    out_str += "\n\nNEW CASES:\n"
-    out_str += ", ".join([str(data[date_str]["new"]) for date_str in date_str_list])
-    with open(os.path.join(OUT_DIR, "statistics.txt"), "w+") as outfile:
-        outfile.write(out_str)
-
-
-def create_deaths_charts(xlsx_path, date_list):
+
+    with open_output("statistics.txt") as outfile:
+        outfile.write("CASES DATES:\n")
+        outfile.write(join_dates(cases_date_list, "cases_dates", state))
+        outfile.write("\n\nTOTAL CASES:\n")
+        outfile.write(join_series(data["total"], "total_cases", state))
+        outfile.write("\n\nNEW CASES:\n")
+        outfile.write(join_series(data["new"], "new_cases", state))
+
+
+def create_deaths_charts(workbook, date_list, history=None, state=None):
     # There is a two day lag in death data
     deaths_date_list = date_list[:-2]
-    date_str_list = [d.strftime(DAY_FMT) for d in deaths_date_list]
-    data = {d: {} for d in date_str_list}
-
-    death_data = get_excel_data_for_date_range(xlsx_path, date_list, "DateofDeath")
-    for d in date_list:
-        if d in death_data:
-            data[d.strftime(DAY_FMT)] = {
-                "total": safe_lookup(
-                    death_data[d] if d in death_data else None, "Confirmed Total", 0
-                ),
-                "new": safe_lookup(
-                    death_data[d] if d in death_data else None, "Confirmed Deaths", 0
-                ),
-            }
-
-    # Zero out the days going back to February 26
-    for d in date_str_list:
-        if "total" not in data[d]:
-            data[d] = {"total": 0, "new": 0}
-
-    out_str = "\n\n\n\n\nDEATH DATES:\n"
-    out_str += ", ".join([d.strftime(STATISTICS_DAY_FMT) for d in deaths_date_list])
-    out_str += "\n\nTOTAL DEATHS:\n"
-    out_str += ", ".join([str(data[date_str]["total"]) for date_str in date_str_list])
-    out_str += "\n\nNEW DEATHS:\n"
-    out_str += ", ".join([str(data[date_str]["new"]) for date_str in date_str_list])
-    with open(os.path.join(OUT_DIR, "statistics.txt"), "a") as outfile:
-        outfile.write(out_str)
-
-
-def create_statistics_graphs(xlsx_path, today):
+    data = DailyFrame.over(deaths_date_list)
+    # Days going back to February 26 without any deaths are zeroed out
+    fill_series(
+        data.add("total", 0),
+        deaths_date_list,
+        workbook,
+        history,
+        "DateofDeath",
+        "Confirmed Total",
+        "deaths_by_date",
+    )
+    fill_series(
+        data.add("new", 0),
+        deaths_date_list,
+        workbook,
+        history,
+        "DateofDeath",
+        "Confirmed Deaths",
+        "new_deaths_by_date",
+    )
+
+    with open_output("statistics.txt", "a") as outfile:
+        outfile.write("\n\n\n\n\nDEATH DATES:\n")
+        outfile.write(join_dates(deaths_date_list, "deaths_dates", state))
+        outfile.write("\n\nTOTAL DEATHS:\n")
+        outfile.write(join_series(data["total"], "total_deaths", state))
+        outfile.write("\n\nNEW DEATHS:\n")
+        outfile.write(join_series(data["new"], "new_deaths", state))
+
+
+def create_statistics_graphs(workbook, today, history=None, state=None):
+    """Writes the statistics charts. If a history store is passed in, the series are
+    read from it rather than from the workbook. If a render state is passed in, only
+    the values that have changed since the last run are formatted again."""
     date_list = create_date_list(today)
-    create_cases_charts(xlsx_path, date_list)
-    create_deaths_charts(xlsx_path, date_list)
+    create_cases_charts(workbook, date_list, history, state)
+    create_deaths_charts(workbook, date_list, history, state)
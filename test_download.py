@@ -0,0 +1,139 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Checks the download layer against a local stand-in for the MDPH server. Run from
+the repository root with pytest."""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download
+
+# Big enough that some whole chunks are written before a cut-off halfway through
+BODY = bytes(range(256)) * 1600
+ETAG = '"v1"'
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Serves BODY with an ETag, honouring If-None-Match, Range and If-Range. Each of
+    the server's failures is used up by one request, in order: a status to send
+    instead, or "cut" to stop halfway through the body."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        failure = self.server.failures.pop(0) if self.server.failures else None
+        if isinstance(failure, int):
+            self.send_response(failure)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.end_headers()
+            return
+        start = 0
+        ranged = self.headers.get("Range")
+        if ranged and self.headers.get("If-Range") == ETAG:
+            start = int(ranged.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                "bytes {}-{}/{}".format(start, len(BODY) - 1, len(BODY)),
+            )
+        else:
+            self.send_response(200)
+        body = BODY[start:]
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if failure == "cut":
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(download, "DOWNLOAD_BACKOFF", 0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.failures = []
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = "http://127.0.0.1:{}/september-10-2021".format(server.server_port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_server_errors(server, tmp_path):
+    path = str(tmp_path / "data.xlsx")
+    server.failures = [503, 503]
+    assert download.download(server.url, path) == len(BODY)
+    assert len(server.requests) == 3
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+
+
+def test_gives_up_after_retries(server, tmp_path):
+    server.failures = [503] * (download.DOWNLOAD_RETRIES + 1)
+    with pytest.raises(download.TransientDownloadError):
+        download.download(server.url, str(tmp_path / "data.xlsx"))
+
+
+def test_revalidates_a_copy_we_have(server, tmp_path):
+    path = str(tmp_path / "data.xlsx")
+    download.download(server.url, path)
+    assert download.download(server.url, path) == 0
+    assert server.requests[-1]["If-None-Match"] == ETAG
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+
+
+def test_resumes_a_cut_off_download(server, tmp_path):
+    path = str(tmp_path / "data.xlsx")
+    server.failures = ["cut"]
+    download.download(server.url, path)
+    assert len(server.requests) == 2
+    # It picks up after the last whole chunk that was written
+    start = int(server.requests[1]["Range"].split("=")[1].rstrip("-"))
+    assert 0 < start <= len(BODY) // 2
+    assert server.requests[1]["If-Range"] == ETAG
+    assert not os.path.exists(path + ".part")
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+
+
+def test_revalidates_into_a_buffer(server):
+    import io
+
+    meta = {}
+    buffer = io.BytesIO()
+    assert download.download_to_buffer(server.url, buffer, meta=meta) == len(BODY)
+    assert meta["etag"] == ETAG
+    assert download.download_to_buffer(server.url, io.BytesIO(), meta=meta) == 0
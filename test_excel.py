@@ -0,0 +1,41 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Checks that the XML reader reads the same values as openpyxl. Run from the
+repository root with pytest."""
+
+from benchmarks.workbook import make_workbook
+from excel import OpenpyxlReader, XlsxReader
+
+
+def test_xml_reader_matches_openpyxl(tmp_path):
+    path = str(tmp_path / "workbook.xlsx")
+    make_workbook(path, years=0.25, padding=2)
+    expected = OpenpyxlReader(path)
+    actual = XlsxReader(path)
+    try:
+        assert actual.sheetnames == expected.sheetnames
+        for sheetname in expected.sheetnames:
+            assert list(actual.rows(sheetname)) == list(
+                expected.rows(sheetname)
+            ), sheetname
+    finally:
+        expected.close()
+        actual.close()
@@ -0,0 +1,86 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Checks that the vaccination data can be read from the sources that don't prompt
+for it. Run from the repository root with pytest."""
+
+import json
+
+import pytest
+
+from manual_data import read_cdc_report, read_manual_file
+
+FIELDS = {
+    "one_dose": "4,800,123 (69.1%)",
+    "fully_vaccinated": "4,300,000 (62.4%)",
+    "as_of": "2021-09-08",
+}
+
+CDC_REPORT = """<html><p>{as_of}</p><table>
+<tr><td>People Receiving at Least One Dose</td><td>4,800,123</td><td>69.1%</td></tr>
+<tr><td>People Fully Vaccinated</td><td>4,300,000</td><td>62.4%</td></tr>
+</table></html>"""
+
+
+@pytest.mark.parametrize(
+    "as_of",
+    [
+        "Data as of: September 8, 2021",
+        "As of September 8, 2021",
+        "As of Sep 8, 2021",
+        "AS OF 2021-09-08",
+    ],
+)
+def test_read_cdc_report(tmp_path, as_of):
+    path = tmp_path / "report.html"
+    path.write_text(CDC_REPORT.format(as_of=as_of))
+    assert read_cdc_report(str(path)) == FIELDS
+
+
+def test_read_cdc_report_missing_figure(tmp_path):
+    path = tmp_path / "report.txt"
+    path.write_text("As of September 8, 2021 nothing else")
+    with pytest.raises(Exception, match="Couldn't find this in the CDC report"):
+        read_cdc_report(str(path))
+
+
+def test_read_manual_file_json(tmp_path):
+    path = tmp_path / "vax.json"
+    path.write_text(json.dumps(FIELDS))
+    assert read_manual_file(str(path)) == FIELDS
+
+
+def test_read_manual_file_yaml(tmp_path):
+    pytest.importorskip("yaml")
+    path = tmp_path / "vax.yaml"
+    # The date is left unquoted, so YAML reads it as a date
+    path.write_text(
+        'one_dose: "4,800,123 (69.1%)"\n'
+        'fully_vaccinated: "4,300,000 (62.4%)"\n'
+        "as_of: 2021-09-08\n"
+    )
+    assert read_manual_file(str(path)) == FIELDS
+
+
+def test_read_manual_file_missing_fields(tmp_path):
+    path = tmp_path / "vax.json"
+    path.write_text(json.dumps({"one_dose": FIELDS["one_dose"]}))
+    with pytest.raises(Exception, match="missing some fields"):
+        read_manual_file(str(path))
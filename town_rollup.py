@@ -0,0 +1,93 @@
+# Copyright (c) 2020-2021 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+from array import array
+from functools import lru_cache
+from constants import *
+from render import open_output
+
+
+@lru_cache(maxsize=None)
+def load_town_counties(path=os.path.join(DATA_DIR, TOWN_COUNTIES_FILE)):
+    """Loads the town -> county lookup table. The first line of the file lists the
+    counties, and each line after it is a town and the position of its county in that
+    list. Returns the counties and a dict of town -> county position. The table is
+    only read once per process, so callers mustn't change it."""
+    with open(path) as f:
+        counties = [sys.intern(c) for c in f.readline().rstrip("\n").split("\t")]
+        codes = {}
+        for line in f:
+            town, code = line.rstrip("\n").split("\t")
+            codes[sys.intern(town)] = int(code)
+    return counties, codes
+
+
+def roll_up(table, counties, codes):
+    """Sums each of the TOWN_VALUE_HEADINGS columns by county in a single pass over the
+    towns. Returns a dict of heading -> per-county totals (in the same order as
+    counties), plus the towns that couldn't be matched to a county."""
+    headings = table[0]
+    town_col = headings.index(TOWN_HEADING)
+    value_cols = [headings.index(h) for h in TOWN_VALUE_HEADINGS]
+    totals = [array("q", [0]) * len(counties) for _ in value_cols]
+    unmatched = []
+
+    for row in table[1:]:
+        town = row[town_col]
+        if not town or town.strip() in TOWN_SKIPPED_ROWS:
+            continue
+        code = codes.get(town.strip())
+        if code is None:
+            unmatched.append(town)
+            continue
+        for col_totals, col in zip(totals, value_cols):
+            # Small counts are sometimes suppressed and reported as text like "<5"
+            if isinstance(row[col], (int, float)):
+                col_totals[code] += int(row[col])
+
+    return dict(zip(TOWN_VALUE_HEADINGS, totals)), unmatched
+
+
+def create_rollup_text(totals, counties, unmatched):
+    lines = ["County\t" + "\t".join(TOWN_VALUE_HEADINGS)]
+    for code, county in enumerate(counties):
+        lines.append(
+            "{}\t{}".format(
+                county,
+                "\t".join("{:,}".format(totals[h][code]) for h in TOWN_VALUE_HEADINGS),
+            )
+        )
+    lines.append(
+        "Statewide\t"
+        + "\t".join("{:,}".format(sum(totals[h])) for h in TOWN_VALUE_HEADINGS)
+    )
+    if unmatched:
+        lines.append("\nNot matched to a county: " + ", ".join(unmatched))
+    return "\n".join(lines)
+
+
+def create_town_rollup(workbook):
+    counties, codes = load_town_counties()
+    totals, unmatched = roll_up(workbook.get_table(TOWN_SHEET), counties, codes)
+    with open_output("town_rollup.txt") as f:
+        f.write(create_rollup_text(totals, counties, unmatched))